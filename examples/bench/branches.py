@@ -0,0 +1,66 @@
+# branches.py - benchmarks for rendering templates with many
+# conditional sections, of which few are taken.
+#
+# Each benchmark below is a function which, given the number of
+# sections of the template, returns a callable rendering it once.
+# Each section refers to names of its own, so that the eager
+# benchmark looks up every one of them from the context on each
+# render, while the lazy one, with lazy_declares, looks up those
+# of the section which is shown.
+#
+# usage: python branches.py [benchmark ...] [-n sections] [-v]
+
+import sys
+import timeit
+
+__all__ = ['eager', 'lazy']
+
+def _template(sections):
+    return "\n".join([
+        "%% if section == %(i)d:\n"
+        "<h1>${title%(i)d}</h1>\n"
+        "<p>${intro%(i)d}</p>\n"
+        "%% for item in items%(i)d:\n"
+        "<li>${item} ${note%(i)d}</li>\n"
+        "%% endfor\n"
+        "%% endif" % {'i':i} for i in range(sections)])
+
+def _benchmark(sections, verbose, **kw):
+    from mako.template import Template
+    t = Template(_template(sections), **kw)
+    data = {'section':0}
+    for i in range(sections):
+        data.update({'title%d' % i:'title', 'intro%d' % i:'intro',
+                    'items%d' % i:range(3), 'note%d' % i:'note'})
+    def run():
+        return t.render_unicode(**data)
+    if verbose:
+        print t.code
+    return run
+
+def eager(sections, verbose=False):
+    return _benchmark(sections, verbose)
+
+def lazy(sections, verbose=False):
+    return _benchmark(sections, verbose, lazy_declares=True)
+
+def run(benchmarks, sections=20, number=1000, verbose=False):
+    for name in benchmarks:
+        print '%s:' % name.capitalize(),
+        t = timeit.Timer(setup='from __main__ import %s; run = %s(%d, %s)'
+                                    % (name, name, sections, verbose),
+                         stmt='run()')
+        time = min(t.repeat(repeat=3, number=number)) / number
+        print '%.3f ms' % (1000 * time)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sections = 20
+    if '-n' in args:
+        idx = args.index('-n')
+        sections = int(args[idx + 1])
+        del args[idx:idx + 2]
+    benchmarks = [arg for arg in args if arg[0] != '-']
+    if not benchmarks:
+        benchmarks = __all__
+    run(benchmarks, sections=sections, verbose='-v' in args)
@@ -0,0 +1,133 @@
+# compile.py - benchmarks for the stages of template compilation.
+#
+# Each benchmark below is a function which, given the size of the
+# generated template, returns a callable performing one run of the
+# benchmarked stage.  The synthetic templates are produced by
+# repeating the "mako" template used by basic.py.
+#
+# usage: python compile.py [benchmark ...] [-n copies] [-v]
+
+import os
+import sys
+import timeit
+
+__all__ = ['lexer', 'expressions', 'nested', 'codegen', 'pygen', 'module']
+
+def large_template(copies):
+    """return the text of the basic.py mako template, repeated
+    'copies' times with distinct def names."""
+
+    dirname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mako')
+    text = open(os.path.join(dirname, 'template.html')).read()
+    return "\n".join([text.replace('greeting', 'greeting%d' % i)
+                        for i in range(copies)])
+
+def lexer(copies, verbose=False):
+    from mako.lexer import Lexer
+    text = large_template(copies)
+    def run():
+        Lexer(text).parse()
+    return run
+
+def expressions(copies, verbose=False):
+    from mako.lexer import Lexer
+    from mako import ast
+    text = "\n".join([
+        "<td>${row%d.name}</td><td>${value%d | h}</td><td>${value%d + 1}</td>"
+        % (i, i, i) for i in range(copies * 10)])
+    def run():
+        # distinct expressions each time, as when compiling a
+        # large tree of templates
+        ast.analysis_memo.clear()
+        Lexer(text).parse()
+    return run
+
+def nested(copies, verbose=False):
+    from mako.lexer import Lexer
+    from mako import codegen
+    depth = 20
+    text = "<%def name='wrap()'>${caller.body()}</%def>\n" + \
+        "".join([
+            "<%call expr='wrap()'>\n% if x:\n${x}\n% endif\n" * depth + 
+            "</%call>\n" * depth
+            for i in range(copies // 10)])
+    node = Lexer(text).parse()
+    def run():
+        codegen.compile(node, 'nested', default_filters=['unicode'])
+    return run
+
+def codegen(copies, verbose=False):
+    from mako.lexer import Lexer
+    from mako import codegen
+    node = Lexer(large_template(copies)).parse()
+    def run():
+        codegen.compile(node, 'large', default_filters=['unicode'])
+    return run
+
+def pygen(copies, verbose=False):
+    # the formatting of the lines of generated code by PythonPrinter,
+    # replaying those which codegen writes for the template
+    from mako.lexer import Lexer
+    from mako import codegen, pygen, util
+    calls = []
+    class Recorder(pygen.PythonPrinter):
+        def write(self, text):
+            calls.append(('write', text))
+            pygen.PythonPrinter.write(self, text)
+        def writeline(self, line):
+            calls.append(('writeline', line))
+            pygen.PythonPrinter.writeline(self, line)
+        def writeline_plain(self, line):
+            calls.append(('writeline_plain', line))
+            pygen.PythonPrinter.writeline_plain(self, line)
+        def write_indented_block(self, block):
+            calls.append(('write_indented_block', block))
+            pygen.PythonPrinter.write_indented_block(self, block)
+    node = Lexer(large_template(copies)).parse()
+    codegen.PythonPrinter = Recorder
+    try:
+        codegen.compile(node, 'large', default_filters=['unicode'])
+    finally:
+        codegen.PythonPrinter = pygen.PythonPrinter
+    if verbose:
+        print '%d calls' % len(calls),
+    def run():
+        printer = pygen.PythonPrinter(util.FastEncodingBuffer())
+        for name, arg in calls:
+            getattr(printer, name)(arg)
+        printer.close()
+    return run
+
+def module(copies, verbose=False):
+    # the compilation of the generated source by Python, which 
+    # Template does after codegen
+    from mako.lexer import Lexer
+    from mako import codegen
+    node = Lexer(large_template(copies)).parse()
+    source = codegen.compile(node, 'large', default_filters=['unicode'])
+    if verbose:
+        print '%d lines' % source.count('\n'),
+    def run():
+        compile(source, 'large', 'exec')
+    return run
+
+def run(benchmarks, copies=200, number=10, verbose=False):
+    for name in benchmarks:
+        print '%s:' % name.capitalize(),
+        t = timeit.Timer(setup='from __main__ import %s; run = %s(%d, %s)'
+                                    % (name, name, copies, verbose),
+                         stmt='run()')
+        time = min(t.repeat(repeat=3, number=number)) / number
+        print '%.2f ms' % (1000 * time)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    copies = 200
+    if '-n' in args:
+        idx = args.index('-n')
+        copies = int(args[idx + 1])
+        del args[idx:idx + 2]
+    benchmarks = [arg for arg in args if arg[0] != '-']
+    if not benchmarks:
+        benchmarks = __all__
+    run(benchmarks, copies=copies, verbose='-v' in args)
@@ -0,0 +1,99 @@
+# filters.py - benchmarks for rendering templates dominated by
+# filtered expressions.
+#
+# Each benchmark below is a function which, given the number of rows
+# to render, returns a callable rendering the template once.
+#
+# usage: python filters.py [benchmark ...] [-n rows] [-v]
+
+import sys
+import timeit
+
+__all__ = ['escape', 'escape_unicode', 'chain', 'entity', 'interpolation',
+            'constants']
+
+template = """
+<table>
+% for row in rows:
+    <tr><td>${row['name'] | FILTERS}</td><td>${row['value'] | FILTERS}</td></tr>
+% endfor
+</table>
+"""
+
+def _rows(count):
+    return [{'name':u'<name %d> & "co"' % i, 'value':i} for i in range(count)]
+
+def _benchmark(filters, rows, verbose, **kw):
+    from mako.template import Template
+    t = Template(template.replace('FILTERS', filters), **kw)
+    data = _rows(rows)
+    def run():
+        return t.render(rows=data)
+    if verbose:
+        print t.code
+    return run
+
+def escape(rows, verbose=False):
+    return _benchmark('h', rows, verbose, disable_unicode=True)
+
+def escape_unicode(rows, verbose=False):
+    return _benchmark('h', rows, verbose)
+
+def chain(rows, verbose=False):
+    return _benchmark('h, trim, unicode', rows, verbose)
+
+def entity(rows, verbose=False):
+    return _benchmark('entity', rows, verbose)
+
+def interpolation(rows, verbose=False):
+    from mako.template import Template
+    t = Template("""
+<table>
+% for row in rows:
+    <tr><td>${row['name']}</td><td>${row['value']}</td><td>${row['name'].upper()}</td><td>${'static'}</td></tr>
+% endfor
+</table>
+""")
+    data = _rows(rows)
+    def run():
+        return t.render_unicode(rows=data)
+    if verbose:
+        print t.code
+    return run
+
+def constants(rows, verbose=False):
+    from mako.template import Template
+    t = Template("""
+<table>
+% for row in rows:
+    <tr><td>${row['name'] | h}</td><td>${'&nbsp;' * 4}</td><td>${"<empty>" | h}</td><td>${len('abc')}</td></tr>
+% endfor
+</table>
+""")
+    data = _rows(rows)
+    def run():
+        return t.render_unicode(rows=data)
+    if verbose:
+        print t.code
+    return run
+
+def run(benchmarks, rows=200, number=100, verbose=False):
+    for name in benchmarks:
+        print '%s:' % name.capitalize(),
+        t = timeit.Timer(setup='from __main__ import %s; run = %s(%d, %s)'
+                                    % (name, name, rows, verbose),
+                         stmt='run()')
+        time = min(t.repeat(repeat=3, number=number)) / number
+        print '%.2f ms' % (1000 * time)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    rows = 200
+    if '-n' in args:
+        idx = args.index('-n')
+        rows = int(args[idx + 1])
+        del args[idx:idx + 2]
+    benchmarks = [arg for arg in args if arg[0] != '-']
+    if not benchmarks:
+        benchmarks = __all__
+    run(benchmarks, rows=rows, verbose='-v' in args)
@@ -8,7 +8,79 @@
 code, as well as generating Python from AST nodes"""
 
 from mako import exceptions, pyparser, util
-import re
+from StringIO import StringIO
+import copy, keyword, re, tokenize, __builtin__
+
+class AnalysisMemo(object):
+    """a bounded, process-wide memo of the results of analyzing 
+    strings of Python code, keyed on the kind of analysis and the 
+    code string itself.  a key is a tuple ending with the code 
+    string, which is also keyed on its type, as the results of 
+    analyzing a str and an equal unicode string hold strings of 
+    their own type.
+ 
+    the same expressions and argument lists tend to recur many times
+    within and across templates; each distinct string is parsed once.
+    ``hits`` and ``misses`` count lookups since the memo was created
+    or last cleared.
+ 
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+ 
+    def clear(self):
+        self._results = util.LRUCache(self.capacity)
+        self.hits = self.misses = 0
+ 
+    def get(self, key):
+        try:
+            result = self._results[key + (type(key[-1]),)]
+        except KeyError:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return result
+ 
+    def put(self, key, result):
+        self._results[key + (type(key[-1]),)] = result
+
+analysis_memo = AnalysisMemo(2000)
+
+# a name or dotted name, such as "${user.name}", which is the most 
+# common form of expression in templates.  the identifiers of such
+# code are determined without parsing it.
+_dotted_name = re.compile(
+                r"([A-Za-z_]\w*)((?:[ \t]*\.[ \t]*[A-Za-z_]\w*)*)[ \t\n]*\Z")
+_attr_name = re.compile(r"[A-Za-z_]\w*")
+# the start of a literal string, or of a call to capture()
+_string_start = re.compile(r"""\s*(?:[uUbBrR]{0,2}['"]|capture\s*\()""")
+_name_list = re.compile(r"[A-Za-z_]\w*(?:[ \t]*,[ \t]*[A-Za-z_]\w*)*[ \t]*\Z")
+
+# builtins whose result depends only on their arguments, which 
+# ConstantValue calls at compile time on constant arguments
+pure_functions = dict([(name, getattr(__builtin__, name)) 
+                        for name in ('abs', 'bool', 'chr', 'float', 'hex', 
+                                    'int', 'len', 'long', 'max', 'min', 
+                                    'oct', 'ord', 'repr', 'round', 'str', 
+                                    'unichr', 'unicode')
+                        if hasattr(__builtin__, name)])
+
+# the longest string or sequence ConstantValue will build
+_constant_limit = 10000
+
+def _simple_name(code):
+    """return the leading identifier of the given code if the code 
+    consists solely of a name or dotted name, else None."""
+ 
+    m = _dotted_name.match(code)
+    if m is None:
+        return None
+    for name in [m.group(1)] + _attr_name.findall(m.group(2)):
+        if keyword.iskeyword(name):
+            return None
+    return str(m.group(1))
 
 class PythonCode(object):
     """represents information about a string containing Python code"""
@@ -31,12 +103,37 @@ class PythonCode(object):
         # (for example, the behavior of co_names changed a little bit
         # in python version 2.5)
         if isinstance(code, basestring):
-            expr = pyparser.parse(code.lstrip(), "exec", **exception_kwargs)
+            name = _simple_name(code.lstrip())
+            if name is not None:
+                if name not in pyparser.reserved:
+                    self.undeclared_identifiers.add(name)
+                return
+            key = ('code', code.lstrip())
+            result = analysis_memo.get(key)
+            if result is not None:
+                self.declared_identifiers = set(result[0])
+                self.undeclared_identifiers = set(result[1])
+                return
+            expr = pyparser.parse(key[1], "exec", **exception_kwargs)
         else:
+            key = None
             expr = code
 
         f = pyparser.FindIdentifiers(self, **exception_kwargs)
         f.visit(expr)
+        if key is not None:
+            analysis_memo.put(key, (
+                                frozenset(self.declared_identifiers), 
+                                frozenset(self.undeclared_identifiers)))
+
+def _copy_code(code):
+    """return a copy of the given PythonCode, with sets of 
+    identifiers of its own."""
+ 
+    code = copy.copy(code)
+    code.declared_identifiers = set(code.declared_identifiers)
+    code.undeclared_identifiers = set(code.undeclared_identifiers)
+    return code
 
 class ArgumentList(object):
     """parses a fragment of code as a comma-separated list of expressions"""
@@ -46,16 +143,216 @@ class ArgumentList(object):
         self.declared_identifiers = set()
         self.undeclared_identifiers = set()
         if isinstance(code, basestring):
+            if not code.strip():
+                return
+            if _name_list.match(code):
+                # a list of plain names, such as the filters "h, trim"
+                names = [str(n.strip()) for n in code.split(',')]
+                if not [n for n in names if keyword.iskeyword(n)]:
+                    for n in names:
+                        p = PythonCode(n, **exception_kwargs)
+                        self.codeargs.append(p)
+                        self.args.append(n)
+                        self.undeclared_identifiers = \
+                            self.undeclared_identifiers.union(
+                                                p.undeclared_identifiers)
+                    return
+            key = ('args', code)
+            result = analysis_memo.get(key)
+            if result is not None:
+                self.codeargs = [_copy_code(p) for p in result[0]]
+                self.args = list(result[1])
+                self.declared_identifiers = set(result[2])
+                self.undeclared_identifiers = set(result[3])
+                return
             if re.match(r"\S", code) and not re.match(r",\s*$", code):
                 # if theres text and no trailing comma, insure its parsed
                 # as a tuple by adding a trailing comma
                 code  += ","
             expr = pyparser.parse(code, "exec", **exception_kwargs)
         else:
+            key = None
             expr = code
 
         f = pyparser.FindTuple(self, PythonCode, **exception_kwargs)
         f.visit(expr)
+        if key is not None:
+            analysis_memo.put(key, (
+                                tuple([_copy_code(p) for p in self.codeargs]), 
+                                tuple(self.args),
+                                frozenset(self.declared_identifiers), 
+                                frozenset(self.undeclared_identifiers)))
+ 
+class CalledNames(object):
+    """determines the functions called by a string of Python code.
+ 
+    ``names`` is the set of plain names which are called, such 
+    as ``len`` in ``len(items)``; it includes None if anything 
+    else is called, such as a method."""
+    def __init__(self, code, **exception_kwargs):
+        self.names = set()
+        # there's no call without parentheses
+        if '(' not in code:
+            return
+        key = ('calls', code.lstrip())
+        result = analysis_memo.get(key)
+        if result is not None:
+            self.names = set(result)
+            return
+        expr = pyparser.parse(key[1], "exec", **exception_kwargs)
+        f = pyparser.FindCalls(self, **exception_kwargs)
+        f.visit(expr)
+        analysis_memo.put(key, frozenset(self.names))
+ 
+class StringType(object):
+    """determines if a string of Python code is an expression which 
+    is known to produce a string.
+ 
+    ``type`` is the type of a literal string, such as ``str`` for 
+    ``"abc"``, or ``basestring`` for a call to ``capture()``, which 
+    returns a string of either type.  it is None if the type isn't 
+    known.  ``value`` is the value of a literal string."""
+    def __init__(self, code, **exception_kwargs):
+        self.type = self.value = None
+        if not _string_start.match(code):
+            return
+        key = ('type', code.strip())
+        result = analysis_memo.get(key)
+        if result is None:
+            expr = pyparser.parse(key[1], "exec", **exception_kwargs)
+            result = pyparser.string_type(expr), None
+            if result[0] is not None and result[0] is not basestring:
+                result = result[0], eval(key[1], {})
+            analysis_memo.put(key, result)
+        self.type, self.value = result
+ 
+class ConstantValue(object):
+    """determines if a string of Python code is an expression whose
+    value can be computed at compile time, being made only of 
+    literals, operators and calls to the builtins in 
+    ``pure_functions``, such as ``'&nbsp;' * 4`` or ``len('abc')``.
+ 
+    ``is_constant`` is True if so, and ``value`` is then the value, 
+    which is a string, number, boolean or None."""
+    def __init__(self, code, **exception_kwargs):
+        key = ('constant', code.strip())
+        result = analysis_memo.get(key)
+        if result is None:
+            expr = pyparser.parse(key[1], "exec", **exception_kwargs)
+            evaluator = pyparser.ConstantEvaluator(pure_functions, 
+                                                    _constant_limit)
+            try:
+                value = evaluator.visit(expr)
+            except Exception:
+                # NotConstant, or an error which is left to be 
+                # raised at runtime
+                result = False, None
+            else:
+                if isinstance(value, (basestring, int, long, float, 
+                                        bool, type(None))):
+                    result = True, value
+                else:
+                    result = False, None
+            analysis_memo.put(key, result)
+        self.is_constant, self.value = result
+ 
+def _tokens(code):
+    """return the tokens of the given code which aren't whitespace
+    or comments, and a function giving the offset into the code of
+    a token's (row, col) position."""
+ 
+    starts = [0]
+    for line in code.splitlines(True):
+        starts.append(starts[-1] + len(line))
+    def offset(pos):
+        return starts[pos[0] - 1] + pos[1]
+    tokens = [t for t in tokenize.generate_tokens(StringIO(code).readline)
+                if t[0] not in (tokenize.NL, tokenize.NEWLINE, 
+                                tokenize.COMMENT, tokenize.INDENT, 
+                                tokenize.DEDENT, tokenize.ENDMARKER)]
+    return tokens, offset
+
+class CallArguments(object):
+    """determines if a string of Python code is a call of a plain 
+    name with no ``*`` or ``**`` arguments, such as ``foo(x, y=5)``.
+ 
+    ``name`` is the name called, or None if the code is anything 
+    else.  ``args`` is the list of the source of each positional 
+    argument, and ``kwargs`` a list of the (name, source) of each 
+    keyword argument, in order."""
+    def __init__(self, code, **exception_kwargs):
+        self.name, self.args, self.kwargs = None, [], []
+        if '(' not in code:
+            return
+        key = ('arguments', code.strip())
+        result = analysis_memo.get(key)
+        if result is None:
+            result = self._parse(key[1])
+            analysis_memo.put(key, result)
+        self.name, self.args, self.kwargs = result
+ 
+    def _parse(self, code):
+        tokens, offset = _tokens(code)
+        if len(tokens) < 3 or \
+                tokens[0][0] != tokenize.NAME or \
+                keyword.iskeyword(tokens[0][1]) or \
+                tokens[1][1] != '(' or tokens[-1][1] != ')':
+            return None, [], []
+        args, kwargs = [], []
+        depth = 0
+        pieces = [[]]
+        for t in tokens[2:-1]:
+            if t[0] == tokenize.OP and t[1] in '([{':
+                depth += 1
+            elif t[0] == tokenize.OP and t[1] in ')]}':
+                if depth == 0:
+                    # such as "foo(x)(y)" or "foo(x) + bar(y)"
+                    return None, [], []
+                depth -= 1
+            elif depth == 0 and t[1] == ',':
+                pieces.append([])
+                continue
+            pieces[-1].append(t)
+        for piece in pieces:
+            if not piece:
+                continue
+            elif piece[0][1] in ('*', '**'):
+                return None, [], []
+            elif len(piece) > 2 and piece[0][0] == tokenize.NAME and \
+                    piece[1][1] == '=':
+                kwargs.append((piece[0][1], 
+                            code[offset(piece[2][2]):offset(piece[-1][3])]))
+            else:
+                args.append(code[offset(piece[0][2]):offset(piece[-1][3])])
+        return tokens[0][1], args, kwargs
+ 
+def rename(code, names):
+    """return the given code with the identifiers which are keys of 
+    the dictionary ``names`` replaced by their values, except where 
+    they're attribute names or the names of keyword arguments."""
+ 
+    tokens, offset = _tokens(code)
+    brackets = []
+    pieces = []
+    copied = 0
+    for i, t in enumerate(tokens):
+        if t[0] == tokenize.OP:
+            if t[1] in '([{':
+                brackets.append(t[1])
+            elif t[1] in ')]}' and brackets:
+                brackets.pop()
+        elif t[0] == tokenize.NAME and t[1] in names:
+            if i and tokens[i - 1][1] == '.':
+                continue
+            elif brackets and brackets[-1] == '(' and \
+                    i + 1 < len(tokens) and tokens[i + 1][1] == '=':
+                continue
+            start = offset(t[2])
+            pieces.append(code[copied:start])
+            pieces.append(names[t[1]])
+            copied = start + len(t[1])
+    pieces.append(code[copied:])
+    return ''.join(pieces)
  
 class PythonFragment(PythonCode):
     """extends PythonCode to provide identifier lookups in partial control statements
@@ -94,14 +391,26 @@ class FunctionDecl(object):
     """function declaration"""
     def __init__(self, code, allow_kwargs=True, **exception_kwargs):
         self.code = code
-        expr = pyparser.parse(code, "exec", **exception_kwargs)
+        key = ('decl', code)
+        result = analysis_memo.get(key)
+        if result is not None:
+            (self.funcname, argnames, defaults, 
+                        self.varargs, self.kwargs) = result
+            self.argnames = list(argnames)
+            self.defaults = list(defaults)
+        else:
+            expr = pyparser.parse(code, "exec", **exception_kwargs)
  
-        f = pyparser.ParseFunc(self, **exception_kwargs)
-        f.visit(expr)
-        if not hasattr(self, 'funcname'):
-            raise exceptions.CompileException(
+            f = pyparser.ParseFunc(self, **exception_kwargs)
+            f.visit(expr)
+            if not hasattr(self, 'funcname'):
+                raise exceptions.CompileException(
                                 "Code '%s' is not a function declaration" % code,
                                 **exception_kwargs)
+            analysis_memo.put(key, (self.funcname, 
+                                tuple(self.argnames), 
+                                tuple(self.defaults),
+                                self.varargs, self.kwargs))
         if not allow_kwargs and self.kwargs:
             raise exceptions.CompileException(
                                 "'**%s' keyword argument not allowed here" % 
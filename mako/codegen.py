@@ -7,11 +7,16 @@
 """provides functionality for rendering a parsetree constructing into module source code."""
 
 import time
+import __builtin__
 import re
 from mako.pygen import PythonPrinter
 from mako import util, ast, parsetree, filters, exceptions
 
-MAGIC_NUMBER = 7
+MAGIC_NUMBER = 8
+
+# the most nodes of text, expressions and control lines which a 
+# <%def> may contain and still be written in place of its calls
+INLINE_THRESHOLD = 10
 
 def compile(node, 
                 uri, 
@@ -22,7 +27,9 @@ def compile(node,
                 source_encoding=None, 
                 generate_magic_comment=True,
                 disable_unicode=False,
-                strict_undefined=False):
+                strict_undefined=False,
+                bind_builtins=False,
+                lazy_declares=False):
  
     """Generate module source code given a parsetree node, 
       uri, and optional source filename"""
@@ -47,7 +54,9 @@ def compile(node,
                                             source_encoding,
                                             generate_magic_comment,
                                             disable_unicode,
-                                            strict_undefined), 
+                                            strict_undefined,
+                                            bind_builtins,
+                                            lazy_declares), 
                                 node)
     return buf.getvalue()
 
@@ -61,7 +70,9 @@ class _CompileContext(object):
                     source_encoding, 
                     generate_magic_comment,
                     disable_unicode,
-                    strict_undefined):
+                    strict_undefined,
+                    bind_builtins,
+                    lazy_declares):
         self.uri = uri
         self.filename = filename
         self.default_filters = default_filters
@@ -71,7 +82,283 @@ class _CompileContext(object):
         self.generate_magic_comment = generate_magic_comment
         self.disable_unicode = disable_unicode
         self.strict_undefined = strict_undefined
+        self.bind_builtins = bind_builtins
+        self.lazy_declares = lazy_declares
+ 
+def _coalesce_text(nodes, fusable=None, fold=None):
+    """return the given list of nodes, with each run of Text nodes 
+    separated only by nodes which write nothing in place, such 
+    as comments and <%def> tags, joined into a single Text node so
+    that the static text is written with one call.  the parse tree 
+    itself isn't modified.
+ 
+    if ``fusable`` is given, it's called for each Expression node;
+    the expressions for which it returns True join the runs of text
+    around them, and a run containing any of them is replaced by 
+    a _WriteRun, written with a single format operation.
+ 
+    if ``fold`` is given, each Expression node is replaced by what it
+    returns, which is a Text node for an expression whose output is 
+    known at compile time, or a list of the nodes of an inlined def."""
+ 
+    result = []
+    run = []
+    skipped = []
+    if fold is not None:
+        nodes = _folded(nodes, fold)
+    for node in nodes:
+        if isinstance(node, parsetree.Text) or (
+                fusable is not None and 
+                isinstance(node, parsetree.Expression) and 
+                fusable(node)):
+            run.append(node)
+            continue
+        elif run and _writes_nothing(node):
+            skipped.append(node)
+            continue
+        if run:
+            result.append(_join_run(run))
+            result.extend(skipped)
+            run = []
+            skipped = []
+        result.append(node)
+    if run:
+        result.append(_join_run(run))
+        result.extend(skipped)
+    if fold is not None and not util.py3k:
+        result = _join_loops(result)
+    return result
+
+def _join_loops(nodes):
+    """replace each '% for' loop among the given coalesced nodes whose
+    body is a single Text node, such as one which is all static text 
+    and constant expressions, by a _WriteLoop, which writes the 
+    output of all of its iterations with one call.
+ 
+    the list comprehension which builds the output leaves the loop 
+    variables assigned as the loop would on Python 2, but not on 
+    Python 3, where the loops are left alone."""
+ 
+    result = []
+    i = 0
+    while i < len(nodes):
+        node = nodes[i]
+        result.append(node)
+        i += 1
+        if not isinstance(node, parsetree.ControlLine) or \
+                node.keyword != 'for' or node.isend or \
+                not _for_clause.match(node.text):
+            continue
+        body = []
+        comments = []
+        j = i
+        while j < len(nodes) and \
+                not isinstance(nodes[j], parsetree.ControlLine):
+            if isinstance(nodes[j], parsetree.Comment):
+                comments.append(nodes[j])
+            else:
+                body.append(nodes[j])
+            j += 1
+        if j < len(nodes) and nodes[j].isend and len(body) == 1 and \
+                isinstance(body[0], parsetree.Text):
+            result[-1] = _WriteLoop(node, body[0])
+            result.extend(comments)
+            i = j + 1
+    return result
+
+def _folded(nodes, fold):
+    for node in nodes:
+        if isinstance(node, parsetree.Expression):
+            node = fold(node)
+            if isinstance(node, list):
+                for n in _folded(node, fold):
+                    yield n
+                continue
+        yield node
+
+def _writes_nothing(node):
+    return isinstance(node, (parsetree.Comment, 
+                                parsetree.DefTag, 
+                                parsetree.NamespaceTag)) or \
+            isinstance(node, parsetree.Code) and node.ismodule
+
+def _join_run(run):
+    pieces = []
+    text = []
+    for node in run:
+        if isinstance(node, parsetree.Text):
+            text.append(node)
+        else:
+            if text:
+                pieces.append(_join_text(text))
+                text = []
+            pieces.append(node)
+    if text:
+        pieces.append(_join_text(text))
+    if len(pieces) == 1:
+        return pieces[0]
+    return _WriteRun(pieces)
+
+def _join_text(run):
+    if len(run) == 1:
+        return run[0]
+    first = run[0]
+    content = first.content
+    return parsetree.Text(
+                content[:0].join([n.content for n in run]), 
+                source_file=first.source_file, 
+                lineno=first.lineno, pos=first.pos)
+
+class _WriteRun(object):
+    """a run of adjacent Text and Expression nodes, written by 
+    _GenerateRenderMethod.visit_WriteRun() with one call."""
  
+    __slots__ = ('nodes',)
+ 
+    def __init__(self, nodes):
+        self.nodes = nodes
+ 
+    def accept_visitor(self, visitor):
+        visitor.visit_WriteRun(self)
+
+class _WriteLoop(object):
+    """a '% for' loop whose body is a single Text node, written by 
+    _GenerateRenderMethod.visit_WriteLoop() with one call."""
+ 
+    __slots__ = ('node', 'body')
+ 
+    def __init__(self, node, body):
+        self.node = node
+        self.body = body
+ 
+    def accept_visitor(self, visitor):
+        visitor.visit_WriteLoop(self)
+
+# the clause of a '% for' control line, less its colon and comment
+_for_clause = re.compile(r'\s*(for\s.*?):\s*(?:#.*)?$', re.S)
+
+class _InlineArgs(object):
+    """the assignment of the arguments of a call of an inlined def 
+    to its parameters, written by 
+    _GenerateRenderMethod.visit_InlineArgs()."""
+ 
+    __slots__ = ('node', 'args')
+ 
+    def __init__(self, node, args):
+        self.node = node
+        self.args = args
+ 
+    def accept_visitor(self, visitor):
+        visitor.visit_InlineArgs(self)
+
+# builtins which may be called by an expression written together 
+# with the text around it.  any other call might be of a def, 
+# which writes to the context before it returns.
+_FUSABLE_CALLS = frozenset(['abs', 'bool', 'chr', 'float', 'hex', 'int',
+                            'len', 'long', 'max', 'min', 'oct', 'ord', 
+                            'repr', 'round', 'sorted', 'str', 'unichr', 
+                            'unicode'])
+
+# filters which return text, and write nothing to the context
+_TEXT_FILTERS = frozenset(['h', 'x', 'u', 'trim', 'entity'])
+
+# those of _TEXT_FILTERS which may return unicode, which can't be 
+# formatted with the encoded text of a template with disable_unicode
+_UNICODE_FILTERS = frozenset(['u', 'entity'])
+
+# filter callables which can be bound to a local at the top of a 
+# render function: the builtins, and those of the 'filters' module
+_bindable_filter = re.compile(r'(?:unicode|str|filters\.[\w.]+)$')
+
+# a call of a name with no arguments, such as "${footer()}"
+_plain_call = re.compile(r'\s*[A-Za-z_]\w*\s*\(\s*\)\s*$')
+
+# names which the runtime places in the context, which
+# bind_builtins doesn't take for the builtins of the same name
+_RUNTIME_NAMES = frozenset(['self', 'local', 'parent', 'next', 
+                            'caller', 'capture'])
+
+# filters which give the same result when applied twice
+_IDEMPOTENT_FILTERS = frozenset(['unicode', 'str', 'filters.trim'])
+
+def _static_filter(e):
+    """return the function of a filter callable of the 'filters' 
+    module or a builtin, as matched by _bindable_filter."""
+ 
+    if e.startswith('filters.'):
+        f = filters
+        for attr in e.split('.')[1:]:
+            f = getattr(f, attr)
+        return f
+    else:
+        return getattr(__builtin__, e)
+
+def _is_ascii(text):
+    try:
+        text.decode('ascii')
+    except UnicodeError:
+        return False
+    else:
+        return True
+
+def _collapse_filters(chain, text_type):
+    """remove the redundant filters from the given chain of filter
+    callables, innermost first.  ``text_type`` is the name of the 
+    filter which coerces to unicode, or None in disable_unicode mode."""
+ 
+    result = []
+    for e in chain:
+        if result:
+            last = result[-1]
+            if e == last and e in _IDEMPOTENT_FILTERS:
+                continue
+            elif last == text_type:
+                if e == 'filters.html_entities_escape':
+                    # calls unicode() on its argument itself
+                    result.pop()
+                elif e.startswith('filters.decode.'):
+                    # returns a unicode argument as is
+                    continue
+        result.append(e)
+    return result
+
+def _walk(node):
+    """yield the given node and all of the nodes nested within it."""
+ 
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        yield n
+        stack.extend(n.get_children())
+
+def _undeclared_names(node):
+    """return the names referred to by the given node and the nodes 
+    nested within it."""
+ 
+    names = set()
+    for n in _walk(node):
+        if isinstance(n, parsetree.Tag):
+            names.update(n.expression_undeclared_identifiers)
+        if hasattr(n, 'undeclared_identifiers'):
+            names.update(n.undeclared_identifiers())
+    return names
+
+def _context_names(node):
+    """return the names referred to by the given def and the tags 
+    nested within it, which it may look up in the context it's 
+    called with; or None if it may use that context other than by 
+    name, i.e. it refers to 'context' itself, includes another 
+    template or has a decorator."""
+ 
+    for n in _walk(node):
+        if isinstance(n, parsetree.IncludeTag) or \
+                getattr(n, 'decorator', None):
+            return None
+    names = _undeclared_names(node)
+    if 'context' in names:
+        return None
+    return names
+
 class _GenerateRenderMethod(object):
     """A template visitor object which generates the 
        full module source for a template.
@@ -79,10 +366,11 @@ class _GenerateRenderMethod(object):
     """
     def __init__(self, printer, compiler, node):
         self.printer = printer
-        self.last_source_line = -1
         self.compiler = compiler
         self.node = node
         self.identifier_stack = [None]
+        self.branch_declares = {}
+        self.enclosing_locals = set()
  
         self.in_def = isinstance(node, (parsetree.DefTag, parsetree.BlockTag))
 
@@ -114,7 +402,11 @@ class _GenerateRenderMethod(object):
         else:
             args = [a for a in ['context'] + args]
  
-        self.write_render_callable(
+        if self.in_def and node.funcname in self.compiler.static_defs:
+            self.write_static_callable(node, name, args, 
+                                    self.compiler.static_defs[node.funcname])
+        else:
+            self.write_render_callable(
                             pagetag or node, 
                             name, args, 
                             buffered, filtered, cached)
@@ -122,7 +414,16 @@ class _GenerateRenderMethod(object):
         if defs is not None:
             for node in defs:
                 _GenerateRenderMethod(printer, compiler, node)
+            self.write_source_map()
  
+    def write_source_map(self):
+        """write the map of module lines to template lines, which
+        RichTraceback uses to locate errors in the template."""
+
+        lines, source_lines = self.printer.source_map
+        self.printer.writeline("_source_map = (%r, %r)" % 
+                                (lines, source_lines))
+
     @property
     def identifiers(self):
         return self.identifier_stack[-1]
@@ -172,7 +473,6 @@ class _GenerateRenderMethod(object):
         self.printer.writeline("from mako import runtime, filters, cache")
         self.printer.writeline("UNDEFINED = runtime.UNDEFINED")
         self.printer.writeline("__M_dict_builtin = dict")
-        self.printer.writeline("__M_locals_builtin = locals")
         self.printer.writeline("_magic_number = %r" % MAGIC_NUMBER)
         self.printer.writeline("_modified_time = %r" % time.time())
         self.printer.writeline(
@@ -202,6 +502,19 @@ class _GenerateRenderMethod(object):
             module_identifiers.declared.update(impcode.declared_identifiers)
  
         self.compiler.identifiers = module_identifiers
+        self.compiler.static_defs = {}
+        self.compiler.inline_defs = {}
+        self.compiler.context_names = {}
+        for node in main_identifiers.topleveldefs.values():
+            content = self.static_content(node)
+            if content is not None:
+                self.compiler.static_defs[node.funcname] = content
+                continue
+            inline = self.inline_def(node)
+            if inline is not None:
+                self.compiler.inline_defs[node.funcname] = inline
+        self.compiler.frameless_defs = self.frameless_defs(
+                                main_identifiers.topleveldefs.values())
         self.printer.writeline("_exports = %r" % 
                             [n.name for n in
                             main_identifiers.topleveldefs.values()]
@@ -229,34 +542,45 @@ class _GenerateRenderMethod(object):
             if decorator:
                 self.printer.writeline("@runtime._decorate_toplevel(%s)" % decorator)
  
-        self.printer.writelines(
-            "def %s(%s):" % (name, ','.join(args)),
+        framed = not self.in_def or \
+                    self.node.funcname not in self.compiler.frameless_defs
+        self.printer.writeline("def %s(%s):" % (name, ','.join(args)))
+        if framed:
+            self.printer.writelines(
                 "context.caller_stack._push_frame()",
                 "try:"
-        )
+            )
         if buffered or filtered or cached:
+            if not framed:
+                self.printer.writeline("try:")
             self.printer.writeline("context._push_buffer()")
  
         self.identifier_stack.append(self.compiler.identifiers.branch(self.node))
         if (not self.in_def or self.node.is_block) and '**pageargs' in args:
             self.identifier_stack[-1].argument_declared.add('pageargs')
 
-        if not self.in_def and (
-                                len(self.identifiers.locally_assigned) > 0 or
-                                len(self.identifiers.argument_declared) > 0
-                                ):
-            self.printer.writeline("__M_locals = __M_dict_builtin(%s)" % 
-                                    ','.join([
-                                            "%s=%s" % (x, x) for x in
-                                            self.identifiers.argument_declared
-                                            ]))
+        if not self.in_def:
+            self.enclosing_locals = self.enclosing_scope()
+            if self.enclosing_locals:
+                self.printer.writeline(
+                            "__M_locals = __M_dict_builtin(%s)" % 
+                            ','.join(["%s=%s" % (x, x) for x in 
+                                sorted(self.enclosing_locals.intersection(
+                                    self.identifiers.argument_declared))]))
 
-        self.write_variable_declares(self.identifiers, toplevel=True)
+        if self.compiler.lazy_declares:
+            deferred = self.deferred_declares(self.node.nodes)
+        else:
+            deferred = None
+        self.write_variable_declares(self.identifiers, toplevel=True, 
+                                        deferred=deferred)
 
-        for n in self.node.nodes:
+        for n in _coalesce_text(self.node.nodes, 
+                                    self.is_fusable, self.fold_expression):
             n.accept_visitor(self)
 
-        self.write_def_finish(self.node, buffered, filtered, cached)
+        self.write_def_finish(self.node, buffered, filtered, cached, 
+                                callstack=framed)
         self.printer.writeline(None)
         self.printer.write("\n\n")
         if cached:
@@ -265,11 +589,180 @@ class _GenerateRenderMethod(object):
                                 args, buffered, 
                                 self.identifiers, toplevel=True)
  
+    def static_content(self, node):
+        """return the text which the given top-level def or block 
+        writes if it's the same on every call, else None.
+ 
+        this is so for a def or block which takes no arguments, isn't
+        filtered, buffered, cached or decorated, and contains only 
+        text and expressions whose output is known at compile time,
+        as fold_expression() finds it; calls of builtins included 
+        only with bind_builtins."""
+ 
+        if node.get_argument_expressions() or \
+                node.filter_args.args or \
+                node.decorator or \
+                eval(node.attributes.get('buffered', 'False')) or \
+                eval(node.attributes.get('cached', 'False')):
+            return None
+        if self.compiler.disable_unicode:
+            content = ''
+        else:
+            content = u''
+        self.identifier_stack.append(self.compiler.identifiers.branch(node))
+        try:
+            for n in node.nodes:
+                if isinstance(n, parsetree.Comment):
+                    continue
+                elif isinstance(n, parsetree.Expression) and \
+                        n.code.undeclared_identifiers.issubset(
+                                                ast.pure_functions):
+                    # builtins are called per builtins_bound()
+                    n = self.fold_expression(n)
+                if not isinstance(n, parsetree.Text):
+                    return None
+                content += n.content
+        finally:
+            self.identifier_stack.pop()
+        return content
+ 
+    def write_static_callable(self, node, name, args, content):
+        """write the render callable of a top-level def or block whose
+        output is the same on every call, as found by static_content().
+ 
+        the text is written directly, without the frame on the caller
+        stack and the declarations of a full render callable, none of
+        which it uses.  a block is still called through 'self', so 
+        that an inheriting template can override it."""
+ 
+        self.printer.writeline("def %s(%s):" % (name, ','.join(args)))
+        if content:
+            self.write_source_line(node.nodes[0])
+            self.printer.writeline("context.writer()(%s)" % repr(content))
+        self.printer.writelines("return ''", None)
+        self.printer.write("\n\n")
+ 
+    def frameless_defs(self, defs):
+        """return the names of those of the given top-level defs and 
+        blocks whose render callables are written without a frame on 
+        the caller stack.
+ 
+        this is so for a def which refers to neither 'caller' nor a 
+        namespace, contains no <%call>, isn't named by the expression 
+        of a <%call> in the template, and calls only top-level defs 
+        which are frameless themselves; as well as using the context 
+        only by name, per _context_names().  such a def can't observe 
+        the caller stack, nor change what the defs it calls observe 
+        of it."""
+ 
+        namespaces = set(['self', 'local', 'parent', 'next']).\
+                                union(self.compiler.namespaces)
+        called = set()
+        for n in _walk(self.node):
+            if isinstance(n, parsetree.CallTag):
+                called.update(n.code.undeclared_identifiers)
+        toplevel = set([node.funcname for node in defs])
+        calls = {}
+        for node in defs:
+            refs = self.context_names(node)
+            if refs is None or \
+                    'caller' in refs or \
+                    refs.intersection(namespaces) or \
+                    node.funcname in called:
+                continue
+            for n in _walk(node):
+                if isinstance(n, (parsetree.CallTag, 
+                                    parsetree.CallNamespaceTag)):
+                    break
+            else:
+                calls[node.funcname] = refs.intersection(toplevel)
+        # leave out those calling a def which has a frame, until 
+        # there are none
+        changed = True
+        while changed:
+            changed = False
+            for name, names in calls.items():
+                if not names.issubset(calls):
+                    del calls[name]
+                    changed = True
+        return set(calls)
+ 
+    def inline_def(self, node):
+        """return the parameters and body of the given top-level def 
+        if its plain calls may be replaced by its body, else None.
+ 
+        this is so for a def of no more than INLINE_THRESHOLD nodes of
+        text, expressions and control lines, which refer to no names
+        but its parameters, the names assigned by its control lines 
+        and the builtins in ast.pure_functions, and which isn't 
+        filtered, buffered, cached or decorated, or given 
+        inline="False".  such a def doesn't use the context or caller
+        stack, and calls no other def, nor itself.  a call of one 
+        referring to builtins is inlined only if builtins_bound().
+ 
+        the parameters are returned as a list of (name, default) 
+        tuples, where the default is None if there is none.  each 
+        name assigned within the def is renamed to one reserved 
+        for it in the body, so that it doesn't clash with the names 
+        of the render function it's inlined into."""
+ 
+        if node.is_block or \
+                node.filter_args.args or \
+                node.decorator or \
+                not eval(node.attributes.get('inline', 'True')) or \
+                eval(node.attributes.get('buffered', 'False')) or \
+                eval(node.attributes.get('cached', 'False')) or \
+                node.function_decl.varargs or \
+                node.function_decl.kwargs:
+            return None
+        params = []
+        for arg in node.get_argument_expressions():
+            name, default = (arg.split('=', 1) + [None])[:2]
+            if default is not None and not ast.ConstantValue(default, 
+                                    **node.exception_kwargs).is_constant:
+                return None
+            params.append((name, default))
+        body = [n for n in node.nodes 
+                    if not isinstance(n, parsetree.Comment)]
+        if len(body) > INLINE_THRESHOLD:
+            return None
+        assigned = set([name for name, default in params])
+        referenced = set()
+        for n in body:
+            if isinstance(n, parsetree.Expression):
+                if n.code.declared_identifiers:
+                    return None
+                referenced.update(n.code.undeclared_identifiers)
+            elif isinstance(n, parsetree.ControlLine):
+                assigned.update(n.declared_identifiers())
+                referenced.update(n.undeclared_identifiers())
+            elif not isinstance(n, parsetree.Text):
+                return None
+        if not referenced.difference(assigned).issubset(ast.pure_functions):
+            return None
+ 
+        names = dict([(name, "__M_%s_%s" % (node.funcname, name)) 
+                        for name in assigned])
+        renamed = []
+        for n in body:
+            if isinstance(n, parsetree.Expression):
+                n = parsetree.Expression(ast.rename(n.text, names), 
+                                n.escapes, source_file=n.source_file,
+                                lineno=n.lineno, pos=n.pos)
+            elif isinstance(n, parsetree.ControlLine) and not n.isend:
+                n = parsetree.ControlLine(n.keyword, n.isend, 
+                                ast.rename(n.text, names), 
+                                source_file=n.source_file, 
+                                lineno=n.lineno, pos=n.pos)
+            renamed.append(n)
+        return [(names[name], default) for name, default in params], \
+                    referenced.difference(assigned), renamed
+ 
     def write_module_code(self, module_code):
         """write module-level template code, i.e. that which 
         is enclosed in <%! %> tags in the template."""
         for n in module_code:
-            self.write_source_comment(n)
+            self.write_source_line(n)
             self.printer.write_indented_block(n.text)
 
     def write_inherit(self, node):
@@ -300,7 +793,7 @@ class _GenerateRenderMethod(object):
         for node in namespaces.values():
             if node.attributes.has_key('import'):
                 self.compiler.has_ns_imports = True
-            self.write_source_comment(node)
+            self.write_source_line(node)
             if len(node.nodes):
                 self.printer.writeline("def make_namespace():")
                 export = []
@@ -369,7 +862,60 @@ class _GenerateRenderMethod(object):
             self.printer.writeline("pass")
         self.printer.writeline(None)
  
-    def write_variable_declares(self, identifiers, toplevel=False, limit=None):
+    def deferred_declares(self, nodes):
+        """return a dictionary of the names referred to by the given 
+        top-level nodes of a render callable only within a branch of 
+        a '% if', to the ControlLine starting the innermost branch 
+        which contains all of their uses.
+ 
+        a branch within a loop isn't considered, so that the name 
+        is looked up once, nor are the closures of the nested defs
+        within a node, which are written at the top of the function.
+        the names of builtins used by an inlined def are taken to 
+        be used where it's called."""
+ 
+        paths = {}
+        def use(names, frames):
+            path = []
+            for keyword, line in frames:
+                if keyword != 'if':
+                    break
+                path.append(line)
+            for name in names:
+                if name in self.compiler.inline_defs:
+                    use(self.compiler.inline_defs[name][1], frames)
+                if name in paths:
+                    common = paths[name]
+                    i = 0
+                    while i < len(common) and i < len(path) and \
+                            common[i] is path[i]:
+                        i += 1
+                    paths[name] = common[:i]
+                else:
+                    paths[name] = path
+
+        frames = []
+        for node in nodes:
+            if isinstance(node, parsetree.ControlLine):
+                if node.isend:
+                    frames.pop()
+                elif node.is_primary:
+                    use(node.undeclared_identifiers(), frames)
+                    frames.append((node.keyword, node))
+                else:
+                    # the test of an 'elif' is made outside the branch
+                    use(node.undeclared_identifiers(), frames[:-1])
+                    frames[-1] = (frames[-1][0], node)
+            elif [n for n in _walk(node) if 
+                    isinstance(n, (parsetree.DefTag, parsetree.BlockTag))]:
+                use(_undeclared_names(node), [])
+            else:
+                use(_undeclared_names(node), frames)
+        return dict([(name, path[-1]) for name, path in paths.items() 
+                        if path])
+ 
+    def write_variable_declares(self, identifiers, toplevel=False, 
+                                    limit=None, deferred=None):
         """write variable declarations at the top of a function.
  
         the variable declarations are in the form of callable
@@ -414,6 +960,12 @@ class _GenerateRenderMethod(object):
         # (this is used for the caching decorator)
         if limit is not None:
             to_write = to_write.intersection(limit)
+
+        # the names which deferred_declares() found, less the filters
+        # which write_filter_declares() binds here, are looked up in 
+        # the branch which uses them instead, by visitControlLine()
+        if deferred is None:
+            deferred = {}
  
         if toplevel and getattr(self.compiler, 'has_ns_imports', False):
             self.printer.writeline("_import_ns = {}")
@@ -446,46 +998,93 @@ class _GenerateRenderMethod(object):
                             "%s = _mako_get_namespace(context, %r)" % 
                                 (ident, ident)
                             )
+            elif self.compiler.bind_builtins and \
+                    not getattr(self.compiler, 'has_ns_imports', False) and \
+                    ident in __builtin__.__dict__ and \
+                    ident not in _RUNTIME_NAMES and \
+                    not ident.startswith('_'):
+                # referred to as a global of the module, which is the
+                # builtin
+                continue
+            elif ident in deferred and \
+                    ident != 'type' and not _bindable_filter.match(ident):
+                self.branch_declares.setdefault(deferred[ident], []).\
+                                                        append(ident)
             else:
-                if getattr(self.compiler, 'has_ns_imports', False):
-                    if self.compiler.strict_undefined:
-                        self.printer.writelines(
-                        "%s = _import_ns.get(%r, UNDEFINED)" % 
-                        (ident, ident),
-                        "if %s is UNDEFINED:" % ident,
-                            "try:",
-                                "%s = context[%r]" % (ident, ident),
-                            "except KeyError:",
-                                "raise NameError(\"'%s' is not defined\")" % 
-                                    ident,
-                            None, None
-                        )
-                    else:
-                        self.printer.writeline(
-                        "%s = _import_ns.get(%r, context.get(%r, UNDEFINED))" % 
-                        (ident, ident, ident))
-                else:
-                    if self.compiler.strict_undefined:
-                        self.printer.writelines(
-                            "try:",
-                                "%s = context[%r]" % (ident, ident),
-                            "except KeyError:",
-                                "raise NameError(\"'%s' is not defined\")" % 
-                                    ident,
-                            None
-                        )
-                    else:
-                        self.printer.writeline(
-                            "%s = context.get(%r, UNDEFINED)" % (ident, ident)
-                        )
+                self.write_context_declare(ident)
  
-        self.printer.writeline("__M_writer = context.writer()")
+        if limit is None:
+            self.write_filter_declares(identifiers)
+
+        self.printer.writeline_plain("__M_writer = context.writer()")
  
-    def write_source_comment(self, node):
-        """write a source comment containing the line number of the corresponding template line."""
-        if self.last_source_line != node.lineno:
-            self.printer.writeline("# SOURCE LINE %d" % node.lineno)
-            self.last_source_line = node.lineno
+    def write_context_declare(self, ident):
+        """write the lookup of the given name in the context."""
+ 
+        if getattr(self.compiler, 'has_ns_imports', False):
+            if self.compiler.strict_undefined:
+                self.printer.writelines(
+                "%s = _import_ns.get(%r, UNDEFINED)" % 
+                (ident, ident),
+                "if %s is UNDEFINED:" % ident,
+                    "try:",
+                        "%s = context[%r]" % (ident, ident),
+                    "except KeyError:",
+                        "raise NameError(\"'%s' is not defined\")" % 
+                            ident,
+                    None, None
+                )
+            else:
+                self.printer.writeline(
+                "%s = _import_ns.get(%r, context.get(%r, UNDEFINED))" % 
+                (ident, ident, ident))
+        else:
+            if self.compiler.strict_undefined:
+                self.printer.writelines(
+                    "try:",
+                        "%s = context[%r]" % (ident, ident),
+                    "except KeyError:",
+                        "raise NameError(\"'%s' is not defined\")" % 
+                            ident,
+                    None
+                )
+            else:
+                self.printer.writeline_plain(
+                    "%s = context.get(%r, UNDEFINED)" % (ident, ident)
+                )
+ 
+    def write_filter_declares(self, identifiers):
+        """bind the filter functions applied by the expressions 
+        written at the given identifiers' level to local names, so
+        that each application doesn't look up the 'filters' module 
+        attribute or builtin again."""
+ 
+        # builtins which the template assigns to at this level 
+        # can't be bound ahead of the assignment
+        assigned = identifiers.locally_declared.union(
+                                    identifiers.argument_declared)
+        bound = {}
+        coerced = False
+        for args in identifiers.filtered:
+            chain = self.filter_chain(args, True)
+            coerced = coerced or chain == [self.text_filter()]
+            for e in chain:
+                if e not in bound and e not in assigned and \
+                        _bindable_filter.match(e):
+                    bound[e] = "__M_" + re.sub(r'^filters\.', '', e).\
+                                                    replace('.', '_')
+        if coerced and self.text_filter() in bound and \
+                'type' not in assigned:
+            # for the check in visitExpression()
+            bound['type'] = '__M_type'
+        for e in sorted(bound):
+            self.printer.writeline_plain("%s = %s" % (bound[e], e))
+        identifiers.bound_filters = bound
+ 
+    def write_source_line(self, node):
+        """mark the code which follows as generated from the given 
+        node's line of the template."""
+        self.printer.start_source(node.lineno)
 
     def write_def_decl(self, node, identifiers):
         """write a locally-available callable referencing a top-level def"""
@@ -493,9 +1092,13 @@ class _GenerateRenderMethod(object):
         namedecls = node.get_argument_expressions()
         nameargs = node.get_argument_expressions(include_defaults=False)
  
-        if not self.in_def and (
-                                len(self.identifiers.locally_assigned) > 0 or
-                                len(self.identifiers.argument_declared) > 0):
+        if not self.in_def:
+            names = self.enclosing_names(node)
+        else:
+            names = None
+        if names:
+            # pass the local variables of the render body to the def
+            # in its context, to simulate "enclosing scope"
             nameargs.insert(0, 'context.locals_(__M_locals)')
         else:
             nameargs.insert(0, 'context')
@@ -503,6 +1106,64 @@ class _GenerateRenderMethod(object):
         self.printer.writeline("return render_%s(%s)" % (funcname, ",".join(nameargs)))
         self.printer.writeline(None)
  
+    def enclosing_scope(self):
+        """return the local variables of the render body which are 
+        kept in "__M_locals", to pass to the top-level defs it calls.
+
+        these are the body's arguments and the variables assigned in 
+        its python blocks, those within <%call> tags included, which 
+        any top-level def may look up in the context it's called with;
+        all of them if one uses that context other than by name."""
+
+        identifiers = self.identifiers
+        scope = set(identifiers.argument_declared)
+        stack = list(self.node.nodes)
+        while stack:
+            n = stack.pop()
+            if isinstance(n, (parsetree.DefTag, parsetree.BlockTag)):
+                continue
+            if isinstance(n, parsetree.Code) and not n.ismodule:
+                scope.update(n.declared_identifiers())
+            stack.extend(n.get_children())
+        names = set()
+        for node in identifiers.topleveldefs.values():
+            refs = self.context_names(node)
+            if refs is None:
+                return scope
+            names.update(refs)
+        return scope.intersection(names)
+
+    def enclosing_names(self, node):
+        """return the variables of enclosing_scope() which the given 
+        top-level def may look up in the context it's called with, 
+        directly or through the top-level defs it calls."""
+ 
+        identifiers = self.identifiers
+        scope = self.enclosing_locals
+        if not scope:
+            return scope
+        names = set()
+        seen = set([node.funcname])
+        stack = [node]
+        while stack:
+            refs = self.context_names(stack.pop())
+            if refs is None:
+                return scope
+            names.update(refs)
+            for name in refs:
+                if name in identifiers.topleveldefs and name not in seen:
+                    seen.add(name)
+                    stack.append(identifiers.topleveldefs[name])
+        return names.intersection(scope)
+ 
+    def context_names(self, node):
+        """return _context_names() of the given top-level def."""
+ 
+        referenced = self.compiler.context_names
+        if node.funcname not in referenced:
+            referenced[node.funcname] = _context_names(node)
+        return referenced[node.funcname]
+ 
     def write_inline_def(self, node, identifiers, nested):
         """write a locally-available def callable inside an enclosing def."""
 
@@ -515,11 +1176,18 @@ class _GenerateRenderMethod(object):
         filtered = len(node.filter_args.args) > 0 
         buffered = eval(node.attributes.get('buffered', 'False'))
         cached = eval(node.attributes.get('cached', 'False'))
-        self.printer.writelines(
-            "context.caller_stack._push_frame()",
-            "try:"
-            )
+        # nested defs have a frame unless their top-level def doesn't;
+        # those of the body and of <%namespace> tags always do
+        framed = getattr(self.node, 'funcname', None) not in \
+                                    self.compiler.frameless_defs
+        if framed:
+            self.printer.writelines(
+                "context.caller_stack._push_frame()",
+                "try:"
+                )
         if buffered or filtered or cached:
+            if not framed:
+                self.printer.writeline("try:")
             self.printer.writelines(
                 "context._push_buffer()",
                 )
@@ -529,11 +1197,13 @@ class _GenerateRenderMethod(object):
         self.write_variable_declares(identifiers)
  
         self.identifier_stack.append(identifiers)
-        for n in node.nodes:
+        for n in _coalesce_text(node.nodes, 
+                                    self.is_fusable, self.fold_expression):
             n.accept_visitor(self)
         self.identifier_stack.pop()
  
-        self.write_def_finish(node, buffered, filtered, cached)
+        self.write_def_finish(node, buffered, filtered, cached, 
+                                callstack=framed)
         self.printer.writeline(None)
         if cached:
             self.write_cache_decorator(node, node.funcname, 
@@ -653,10 +1323,14 @@ class _GenerateRenderMethod(object):
                 None
             )
 
-    def create_filter_callable(self, args, target, is_expression):
-        """write a filter-applying expression based on the filters 
-        present in the given filter names, adjusting for the global 
-        'default' filter aliases as needed."""
+    def filter_chain(self, args, is_expression):
+        """return the filter callables applied by the given filter 
+        names as Python expressions, innermost first, adjusting for 
+        the global 'default' filter aliases as needed.
+ 
+        filters which are redundant next to the one following them,
+        such as 'unicode' before 'entity', which coerces its argument
+        to unicode itself, are dropped."""
  
         def locate_encode(name):
             if re.match(r'decode\..+', name):
@@ -672,6 +1346,7 @@ class _GenerateRenderMethod(object):
                     args = self.compiler.pagetag.filter_args.args + args
                 if self.compiler.default_filters:
                     args = self.compiler.default_filters + args
+        chain = []
         for e in args:
             # if filter given as a function, get just the identifier portion
             if e == 'n':
@@ -685,11 +1360,72 @@ class _GenerateRenderMethod(object):
                 x = e
                 e = locate_encode(e)
                 assert e is not None
-            target = "%s(%s)" % (e, target)
+            chain.append(e)
+        if self.compiler.disable_unicode:
+            return _collapse_filters(chain, None)
+        else:
+            return _collapse_filters(chain, filters.DEFAULT_ESCAPES['unicode'])
+ 
+    def create_filter_callable(self, args, target, is_expression):
+        """write a filter-applying expression based on the filters 
+        present in the given filter names, adjusting for the global 
+        'default' filter aliases as needed.
+ 
+        the filters of expressions are called by the local names 
+        bound in write_filter_declares(), where there are any."""
+ 
+        return self.apply_filters(self.filter_chain(args, is_expression),
+                                    target, is_expression)
+ 
+    def apply_filters(self, chain, target, is_expression):
+        """write the application of the given chain of filter 
+        callables, as returned by filter_chain(), to the given 
+        Python expression."""
+ 
+        bound = is_expression and \
+                    getattr(self.identifiers, 'bound_filters', None) or {}
+        for e in chain:
+            target = "%s(%s)" % (bound.get(e, e), target)
         return target
  
+    def text_filter(self):
+        """return the filter callable which coerces the result of an
+        expression to text, by default the first filter applied."""
+ 
+        if self.compiler.disable_unicode:
+            return 'str'
+        else:
+            return filters.DEFAULT_ESCAPES['unicode']
+ 
+    def expression_filters(self, node):
+        """return the chain of filter callables to apply to the 
+        given Expression, less a coercion to text which is known
+        to be redundant.
+ 
+        a coercion applied by itself is redundant when the expression
+        is a literal string or call to capture(), which already
+        produce strings; the buffer joins a str with the unicode 
+        around it just as unicode() would."""
+ 
+        chain = self.filter_chain(node.escapes_code.args, True)
+        if not self.filters_bound(node):
+            # the coercion is whatever the template binds the name to
+            return chain
+        coerce = self.text_filter()
+        if chain == [coerce]:
+            string = ast.StringType(node.text, **node.exception_kwargs)
+            if self.compiler.disable_unicode:
+                known = string.type is str
+            elif string.type is str and not util.py3k:
+                known = _is_ascii(string.value)
+            else:
+                known = string.type is not None
+            if known:
+                return []
+        return chain
+ 
     def visitExpression(self, node):
-        self.write_source_comment(node)
+        self.write_source_line(node)
         if len(node.escapes) or \
                 (
                     self.compiler.pagetag is not None and
@@ -697,10 +1433,263 @@ class _GenerateRenderMethod(object):
                 ) or \
                 len(self.compiler.default_filters):
  
-            s = self.create_filter_callable(node.escapes_code.args, "%s" % node.text, True)
-            self.printer.writeline("__M_writer(%s)" % s)
+            chain = self.expression_filters(node)
+            bound = self.identifiers.bound_filters
+            if chain == [self.text_filter()] and \
+                    chain[0] in bound and 'type' in bound:
+                # skip the call when the value is text already
+                coerce = bound[chain[0]]
+                self.printer.writeline_plain("__M_value = (%s)" % node.text)
+                self.printer.writelines(
+                    "if %s(__M_value) is not %s:" % (bound['type'], coerce),
+                        "__M_value = %s(__M_value)" % coerce,
+                    None
+                )
+                self.printer.writeline_plain("__M_writer(__M_value)")
+            else:
+                self.printer.writeline_plain("__M_writer(%s)" % 
+                            self.apply_filters(chain, node.text, True))
+        else:
+            self.printer.writeline_plain("__M_writer(%s)" % node.text)
+ 
+    def is_fusable(self, node):
+        """return True if the given Expression may be written together
+        with the text and expressions around it.
+ 
+        the expression is evaluated before anything ahead of it in 
+        the run is written, so it may call only the builtins in 
+        _FUSABLE_CALLS, as any other call might be of a def which 
+        writes to the context.  its filters must be known to return 
+        text which can be formatted together with the template's own."""
+ 
+        args = node.escapes_code.args
+        if 'n' not in args:
+            if self.compiler.pagetag:
+                args = self.compiler.pagetag.filter_args.args + args
+            if self.compiler.default_filters:
+                args = self.compiler.default_filters + args
+        args = [e for e in args if e != 'n']
+        if not args:
+            return False
+        for e in args:
+            if e in _TEXT_FILTERS:
+                if self.compiler.disable_unicode and \
+                        e in _UNICODE_FILTERS:
+                    return False
+                continue
+            elif self.compiler.disable_unicode:
+                if e != 'str':
+                    return False
+            elif not (e == 'unicode' or 
+                        util.py3k and e == 'str' or 
+                        re.match(r'decode\..+', e)):
+                return False
+        calls = ast.CalledNames(node.text, **node.exception_kwargs)
+        return calls.names.issubset(_FUSABLE_CALLS)
+ 
+    def fold_expression(self, node):
+        """return a Text node in place of the given Expression if its
+        output can be computed at compile time, else the Expression.
+ 
+        the expression must be made only of literals, operators and 
+        calls to the builtins in ast.pure_functions, which are called 
+        only if builtins_bound() finds they refer to the builtins, and
+        its filters must be those of the 'filters' module or builtins,
+        applied only if filters_bound() finds the template doesn't 
+        bind their names itself; these are all free of side effects, 
+        and give the same result on every render.  a call with no 
+        arguments of a top-level def whose output is static is 
+        replaced by that output."""
+ 
+        names = node.code.undeclared_identifiers
+        if node.code.declared_identifiers:
+            return node
+        inlined = self.inline_call(node)
+        if inlined is not None:
+            return inlined
+        content = self.static_call(node, names)
+        if content is not None:
+            # the def returns an empty string after writing
+            if not self.filters_bound(node) or \
+                    self.static_filters(node, content[:0]) != '':
+                return node
+        elif not names.issubset(ast.pure_functions) or \
+                not self.builtins_bound(names):
+            return node
+        else:
+            const = ast.ConstantValue(node.text, **node.exception_kwargs)
+            if not const.is_constant or not self.filters_bound(node):
+                return node
+            content = self.static_filters(node, const.value)
+            if content is None:
+                return node
+        return parsetree.Text(content, source_file=node.source_file, 
+                                lineno=node.lineno, pos=node.pos)
+ 
+    def filters_bound(self, node):
+        """return True if the filter callables applied to the given 
+        Expression refer to those of the 'filters' module and the 
+        builtins where the current identifiers are in effect, i.e. 
+        the template doesn't bind their names itself, such as with 
+        <% unicode = ... %>."""
+ 
+        names = set([re.match(r'\w+', e).group(0) for e in 
+                        self.filter_chain(node.escapes_code.args, True)])
+        return not self.shadowed(names)
+
+    def builtins_bound(self, names):
+        """return True if the given names of builtins refer to the 
+        builtins themselves where the current identifiers are in 
+        effect.
+
+        by default a builtin is looked up in the context like any
+        other name, which a variable passed to render() may replace;
+        with bind_builtins, it's the builtin, unless a namespace 
+        imports names into the template or the template binds the 
+        name itself."""
+ 
+        if not names:
+            return True
+        if not self.compiler.bind_builtins:
+            return False
+        for node in self.compiler.namespaces.values():
+            if node.attributes.has_key('import'):
+                return False
+        return not self.shadowed(names)
+
+    def shadowed(self, names):
+        """return True if any of the given names, of builtins or of 
+        top-level defs, may be bound to something else where the 
+        current identifiers are in effect."""
+ 
+        identifiers = self.identifiers
+        return bool(names.intersection(identifiers.declared) or 
+                    names.intersection(identifiers.locally_declared) or 
+                    names.intersection(identifiers.argument_declared) or 
+                    names.intersection(identifiers.closuredefs.keys()))
+ 
+    def static_call(self, node, names):
+        """return the output of the top-level def called by the given 
+        Expression, if the expression is a plain call of it with no 
+        arguments, static_content() found its output and it isn't 
+        given inline="False", else None."""
+ 
+        if len(names) != 1 or not _plain_call.match(node.text):
+            return None
+        name = list(names)[0]
+        content = self.compiler.static_defs.get(name)
+        if content is None:
+            return None
+        node = self.identifiers.topleveldefs[name]
+        if node.is_block or \
+                not eval(node.attributes.get('inline', 'True')) or \
+                self.shadowed(names):
+            return None
+        return content
+ 
+    def inline_call(self, node):
+        """return the nodes which replace the given Expression, if 
+        it's a call of a def found by inline_def() which can be 
+        inlined here: the assignment of its arguments, followed by 
+        the def's body.  else None."""
+ 
+        call = ast.CallArguments(node.text, **node.exception_kwargs)
+        if call.name not in self.compiler.inline_defs:
+            return None
+        params, builtins, body = self.compiler.inline_defs[call.name]
+        # the builtins the body refers to must be those in the 
+        # def's render function, where they're looked up in the 
+        # context unless bound
+        if self.shadowed(set([call.name])) or \
+                not self.builtins_bound(builtins):
+            return None
+        # the def returns an empty string after writing
+        if not self.filters_bound(node) or \
+                self.static_filters(node, '') != '':
+            return None
+        if len(call.args) > len(params):
+            return None
+        names = [name for name, default in params]
+        args = zip(names, call.args)
+        for key, value in call.kwargs:
+            name = "__M_%s_%s" % (call.name, key)
+            if name not in names or name in dict(args):
+                return None
+            args.append((name, value))
+        for name, default in params:
+            if name not in dict(args):
+                if default is None:
+                    return None
+                args.append((name, default))
+        for name, value in args:
+            if '\n' in value:
+                return None
+        return [_InlineArgs(node, args)] + body
+ 
+    def static_filters(self, node, value):
+        """return the text which the filters of the given Expression
+        make of the given value, applied at compile time, or None if 
+        they can't be."""
+ 
+        for e in self.filter_chain(node.escapes_code.args, True):
+            if not _bindable_filter.match(e):
+                return None
+            try:
+                value = _static_filter(e)(value)
+            except Exception:
+                # raised again at runtime
+                return None
+        if self.compiler.disable_unicode:
+            if type(value) is not str:
+                return None
+        elif isinstance(value, unicode):
+            # such as the Markup returned by markupsafe
+            value = unicode(value)
+        elif isinstance(value, str) and _is_ascii(value):
+            value = value.decode('ascii')
+        else:
+            return None
+        return value
+ 
+    def visit_InlineArgs(self, inline):
+        """write the assignment of the arguments of an inlined call."""
+ 
+        self.write_source_line(inline.node)
+        for name, value in inline.args:
+            self.printer.writeline("%s = %s" % (name, value))
+ 
+    def visit_WriteRun(self, run):
+        """write a _WriteRun as a single format operation, with each 
+        expression's filters applied inline."""
+ 
+        if self.compiler.disable_unicode:
+            format = ''
         else:
-            self.printer.writeline("__M_writer(%s)" % node.text)
+            format = u''
+        values = []
+        for node in run.nodes:
+            if isinstance(node, parsetree.Text):
+                format += node.content.replace('%', '%%')
+            else:
+                format += '%s'
+                values.append(node)
+        self.write_source_line(run.nodes[0])
+        self.printer.writeline_plain("__M_writer(%s %% (" % repr(format))
+        for node in values:
+            self.write_source_line(node)
+            self.printer.writeline_plain("%s," % self.apply_filters(
+                                self.expression_filters(node), 
+                                node.text, True))
+        self.printer.writeline_plain("))")
+ 
+    def visit_WriteLoop(self, loop):
+        """write a _WriteLoop as the join of a list comprehension."""
+ 
+        self.write_source_line(loop.node)
+        self.printer.writeline_plain("__M_writer(%s.join([%s %s]))" % (
+                                repr(loop.body.content[:0]), 
+                                repr(loop.body.content), 
+                                _for_clause.match(loop.node.text).group(1)))
  
     def visitControlLine(self, node):
         if node.isend:
@@ -708,12 +1697,14 @@ class _GenerateRenderMethod(object):
                 self.printer.writeline("pass")
             self.printer.writeline(None)
         else:
-            self.write_source_comment(node)
+            self.write_source_line(node)
             self.printer.writeline(node.text)
+            for ident in sorted(self.branch_declares.get(node, ())):
+                self.write_context_declare(ident)
  
     def visitText(self, node):
-        self.write_source_comment(node)
-        self.printer.writeline("__M_writer(%s)" % repr(node.content))
+        self.write_source_line(node)
+        self.printer.writeline_plain("__M_writer(%s)" % repr(node.content))
  
     def visitTextTag(self, node):
         filtered = len(node.filter_args.args) > 0
@@ -722,8 +1713,9 @@ class _GenerateRenderMethod(object):
                 "__M_writer = context._push_writer()",
                 "try:",
             )
-        for n in node.nodes:
-            n.accept_visitor(self)
+        for n in _coalesce_text(node.nodes, 
+                                    self.is_fusable, self.fold_expression):
+            yield n
         if filtered:
             self.printer.writelines(
                 "finally:",
@@ -738,23 +1730,26 @@ class _GenerateRenderMethod(object):
  
     def visitCode(self, node):
         if not node.ismodule:
-            self.write_source_comment(node)
+            self.write_source_line(node)
             self.printer.write_indented_block(node.text)
 
-            if not self.in_def and len(self.identifiers.locally_assigned) > 0:
-                # if we are the "template" def, fudge locally 
-                # declared/modified variables into the "__M_locals" dictionary,
-                # which is used for def calls within the same template, 
+            if not self.in_def:
+                # if we are the "template" def, copy the variables 
+                # this block assigns into the "__M_locals" dictionary,
+                # which is used for def calls within the same template,
                 # to simulate "enclosing scope"
-                self.printer.writeline('__M_locals_builtin_stored = __M_locals_builtin()')
-                self.printer.writeline(
-                            '__M_locals.update(__M_dict_builtin([(__M_key,'
-                            ' __M_locals_builtin_stored[__M_key]) for '
-                            '__M_key in [%s] if __M_key in __M_locals_builtin_stored]))' %
-                            ','.join([repr(x) for x in node.declared_identifiers()]))
+                for x in sorted(self.enclosing_locals.intersection(
+                                        node.declared_identifiers())):
+                    self.printer.writelines(
+                        "try:",
+                            "__M_locals[%r] = %s" % (x, x),
+                        "except NameError:",
+                            "pass",
+                        None
+                    )
 
     def visitIncludeTag(self, node):
-        self.write_source_comment(node)
+        self.write_source_line(node)
         args = node.attributes.get('args')
         if args:
             self.printer.writeline(
@@ -787,7 +1782,7 @@ class _GenerateRenderMethod(object):
         # TODO: we can put namespace-specific checks here, such
         # as ensure the given namespace will be imported,
         # pre-import the namespace, etc.
-        self.visitCallTag(node)
+        return self.visitCallTag(node)
  
     def visitCallTag(self, node):
         self.printer.writeline("def ccall(caller):")
@@ -836,8 +1831,9 @@ class _GenerateRenderMethod(object):
         self.write_variable_declares(body_identifiers)
         self.identifier_stack.append(body_identifiers)
  
-        for n in node.nodes:
-            n.accept_visitor(self)
+        for n in _coalesce_text(node.nodes, 
+                                    self.is_fusable, self.fold_expression):
+            yield n
         self.identifier_stack.pop()
  
         self.write_def_finish(node, buffered, False, False, callstack=False)
@@ -854,7 +1850,7 @@ class _GenerateRenderMethod(object):
             "context.caller_stack.nextcaller = "
                 "runtime.Namespace('caller', context, callables=ccall(__M_caller))",
             "try:")
-        self.write_source_comment(node)
+        self.write_source_line(node)
         self.printer.writelines(
                 "__M_writer(%s)" % self.create_filter_callable([], node.expression, True),
             "finally:",
@@ -915,6 +1911,12 @@ class _Identifiers(object):
         # closure defs that are defined in this level
         self.closuredefs = util.SetLikeDict()
  
+        # the filter arguments of the expressions written at this
+        # level, and the local names to which write_filter_declares()
+        # bound their filter callables
+        self.filtered = []
+        self.bound_filters = {}
+
         self.node = node
  
         if node is not None:
@@ -958,6 +1960,7 @@ class _Identifiers(object):
  
     def visitExpression(self, node):
         self.check_declared(node)
+        self.filtered.append(node.escapes_code.args)
  
     def visitControlLine(self, node):
         self.check_declared(node)
@@ -973,7 +1976,7 @@ class _Identifiers(object):
         # write_namespaces()
         if self.node is node:
             for n in node.nodes:
-                n.accept_visitor(self)
+                yield n
 
     def _check_name_exists(self, collection, node):
         existing = collection.get(node.funcname)
@@ -1001,7 +2004,7 @@ class _Identifiers(object):
             for ident in node.declared_identifiers():
                 self.argument_declared.add(ident)
             for n in node.nodes:
-                n.accept_visitor(self)
+                yield n
 
     def visitBlockTag(self, node):
         if node is not self.node and \
@@ -1024,7 +2027,7 @@ class _Identifiers(object):
         for ident in node.declared_identifiers():
             self.argument_declared.add(ident)
         for n in node.nodes:
-            n.accept_visitor(self)
+            yield n
 
     def visitIncludeTag(self, node):
         self.check_declared(node)
@@ -1035,7 +2038,7 @@ class _Identifiers(object):
         self.check_declared(node)
  
     def visitCallNamespaceTag(self, node):
-        self.visitCallTag(node)
+        return self.visitCallTag(node)
  
     def visitCallTag(self, node):
         if node is self.node:
@@ -1045,9 +2048,11 @@ class _Identifiers(object):
             for ident in node.declared_identifiers():
                 self.argument_declared.add(ident)
             for n in node.nodes:
-                n.accept_visitor(self)
+                yield n
         else:
             for ident in node.undeclared_identifiers():
                 if ident != 'context' and ident not in self.declared.union(self.locally_declared):
                     self.undeclared.add(ident)
+            # the result of the call is written with the default filters
+            self.filtered.append([])
  
@@ -6,7 +6,7 @@
 
 """exception classes"""
 
-import traceback, sys, re
+import traceback, sys, bisect
 from mako import util
 
 class MakoException(Exception):
@@ -130,28 +130,31 @@ class RichTraceback(object):
 
         import mako.template
         mods = {}
+        encodings = {}
         rawrecords = traceback.extract_tb(trcback)
         new_trcback = []
         for filename, lineno, function, line in rawrecords:
             if not line:
                 line = ''
             try:
-                (line_map, template_lines) = mods[filename]
+                (source_map, template_lines, template_source, 
+                    template_filename) = mods[filename]
             except KeyError:
                 try:
                     info = mako.template._get_module_info(filename)
-                    module_source = info.code
-                    template_source = info.source
-                    template_filename = info.template_filename or filename
                 except KeyError:
                     # A normal .py file (not a Template)
                     if not util.py3k:
                         try:
-                            fp = open(filename, 'rb')
-                            encoding = util.parse_encoding(fp)
-                            fp.close()
-                        except IOError:
-                            encoding = None
+                            encoding = encodings[filename]
+                        except KeyError:
+                            try:
+                                fp = open(filename, 'rb')
+                                encoding = util.parse_encoding(fp)
+                                fp.close()
+                            except IOError:
+                                encoding = None
+                            encodings[filename] = encoding
                         if encoding:
                             line = line.decode(encoding)
                         else:
@@ -160,30 +163,35 @@ class RichTraceback(object):
                                             None, None, None, None))
                     continue
 
-                template_ln = module_ln = 1
-                line_map = {}
-                for line in module_source.split("\n"):
-                    match = re.match(r'\s*# SOURCE LINE (\d+)', line)
-                    if match:
-                        template_ln = int(match.group(1))
-                    module_ln += 1
-                    line_map[module_ln] = template_ln
-                template_lines = [line for line in
-                                    template_source.split("\n")]
-                mods[filename] = (line_map, template_lines)
+                source_map = getattr(info.module, '_source_map', None)
+                template_source = info.source
+                template_filename = info.template_filename or filename
+                template_lines = template_source.split("\n")
+                mods[filename] = (source_map, template_lines, 
+                                    template_source, template_filename)
 
-            template_ln = line_map[lineno]
+            # the module lines generated from each template line 
+            # start at the line numbers in source_map[0]
+            if source_map is None:
+                # a module compiled without the map
+                template_ln, start = lineno, None
+            else:
+                idx = bisect.bisect_right(source_map[0], lineno) - 1
+                if idx < 0:
+                    # module code ahead of that of the template
+                    template_ln, start = 1, None
+                else:
+                    template_ln = source_map[1][idx]
+                    start = source_map[0][idx]
             if template_ln <= len(template_lines):
                 template_line = template_lines[template_ln - 1]
             else:
                 template_line = None
             
             # calculate line number offset for python block
-            lineno_offset = 0
-            if template_line.startswith('<%'):
-                while line_map[lineno - lineno_offset] == template_ln:
-                    lineno_offset += 1
-                template_ln = template_ln + lineno_offset - 1
+            if start is not None and template_line is not None and \
+                    template_line.startswith('<%'):
+                template_ln += lineno - start
                 if template_ln <= len(template_lines):
                     template_line = template_lines[template_ln - 1]
                 else:
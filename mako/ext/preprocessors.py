@@ -9,12 +9,122 @@ argument on Template, TemplateLookup"""
 
 import re
 
-def convert_comments(text):
-    """preprocess old style comments.
- 
+class RegexPreprocessor(object):
+    """a preprocessor which replaces each match of a regular
+    expression with the given replacement, as ``re.sub()``.
+
+    the fingerprint of a RegexPreprocessor is derived from its
+    pattern, replacement and flags, so that its output can be 
+    cached when the replacement is a string, and several may be 
+    combined into a single pass over the template with :func:`.fuse`.
+
+    """
+    def __init__(self, pattern, repl, flags=0, name=None):
+        self.pattern = pattern
+        self.repl = repl
+        self.flags = flags
+        self.regexp = re.compile(pattern, flags)
+        self.__name__ = name or "RegexPreprocessor(%r)" % pattern
+
+    @property
+    def fingerprint(self):
+        if not isinstance(self.repl, basestring):
+            return None
+        return "%s(%r, %r, %d)" % (self.__class__.__name__,
+                                    self.pattern, self.repl, self.flags)
+
+    def __call__(self, text):
+        return self.regexp.sub(self.repl, text)
+
+    def __repr__(self):
+        return "%s(%r, %r, %d)" % (self.__class__.__name__,
+                                    self.pattern, self.repl, self.flags)
+
+class FusedPreprocessor(object):
+    """a preprocessor which applies the substitutions of several
+    RegexPreprocessors in a single pass.  see :func:`.fuse`."""
+
+    def __init__(self, preprocessors, name=None):
+        self.preprocessors = preprocessors
+        self.__name__ = name or "fuse(%s)" % ", ".join(
+                                    [p.__name__ for p in preprocessors])
+
+    @property
+    def fingerprint(self):
+        fingerprints = [p.fingerprint for p in self.preprocessors]
+        if None in fingerprints:
+            return None
+        return "fuse(%s)" % ", ".join(fingerprints)
+
+    def __call__(self, text):
+        # each pattern searches ahead for its next match, so that 
+        # it can take advantage of its own literal prefix; the 
+        # earliest of these matches is substituted, as re.sub() 
+        # does for a pattern which is the alternation of them all.
+        regexps = [p.regexp for p in self.preprocessors]
+        found = [r.search(text) for r in regexps]
+        pieces = []
+        start = copied = count = 0
+        while True:
+            match = None
+            for i, m in enumerate(found):
+                if m is not None and \
+                        (match is None or m.start() < match.start()):
+                    match, which = m, i
+            if match is None:
+                break
+            begin, end = match.span()
+            if copied < begin:
+                pieces.append(text[copied:begin])
+            # an empty match directly after another isn't replaced
+            if not (begin == end == copied and count):
+                repl = self.preprocessors[which].repl
+                if callable(repl):
+                    pieces.append(repl(match))
+                else:
+                    pieces.append(match.expand(repl))
+                count += 1
+            copied = end
+            if begin == end:
+                start = end + 1
+            else:
+                start = end
+            for i, m in enumerate(found):
+                if m is not None and m.start() < start:
+                    if start > len(text):
+                        found[i] = None
+                    else:
+                        found[i] = regexps[i].search(text, start)
+        pieces.append(text[copied:])
+        return text[:0].join(pieces)
+
+    def __repr__(self):
+        return "fuse(%s)" % ", ".join([repr(p) for p in self.preprocessors])
+
+def fuse(*preprocessors):
+    """combine the given RegexPreprocessors into one which builds
+    the preprocessed template in a single pass.
+
+    at each position of the template, the first of the patterns which
+    matches there is replaced.  all of the patterns are matched against
+    the original text, so the result is the same as applying the
+    preprocessors in turn only when the replacements made by each
+    aren't themselves matched by the others.
+
+    """
+    flattened = []
+    for p in preprocessors:
+        if isinstance(p, FusedPreprocessor):
+            flattened.extend(p.preprocessors)
+        else:
+            flattened.append(p)
+    return FusedPreprocessor(flattened)
+
+convert_comments = RegexPreprocessor(r'(?<=\n)\s*#[^#]', "##",
+                                        name='convert_comments')
+convert_comments.__doc__ = """preprocess old style comments.
+
     example:
- 
+
     from mako.ext.preprocessors import convert_comments
     t = Template(..., preprocessor=preprocess_comments)"""
-    return re.sub(r'(?<=\n)\s*#[^#]', "##", text)
-
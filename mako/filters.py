@@ -20,10 +20,18 @@ xml_escapes = {
 # XXX: &quot; is valid in HTML and XML
 #      &apos; is not valid HTML, but is valid XML
 
+_xml_escape_re = re.compile(r'([&<"\'>])')
+
 def legacy_html_escape(string):
     """legacy HTML escape for non-unicode mode."""
 
-    return re.sub(r'([&<"\'>])', lambda m: xml_escapes[m.group()], string)
+    if not isinstance(string, basestring):
+        return _xml_escape_re.sub(lambda m: xml_escapes[m.group()], string)
+    # the replacements contain none of the escaped characters 
+    # other than '&', which is replaced first
+    return string.replace('&', '&amp;').replace('>', '&gt;').\
+                replace('<', '&lt;').replace('"', '&#34;').\
+                replace("'", '&#39;')
 
 try:
     import markupsafe
@@ -32,8 +40,7 @@ except ImportError:
     html_escape = legacy_html_escape
 
  
-def xml_escape(string):
-    return re.sub(r'([&<"\'>])', lambda m: xml_escapes[m.group()], string)
+xml_escape = legacy_html_escape
 
 def url_escape(string):
     # convert into a list of octets
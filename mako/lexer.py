@@ -6,12 +6,117 @@
 
 """provides the Lexer class for parsing template strings into parse trees."""
 
-import re, codecs
+import re, codecs, bisect, types
 from mako import parsetree, exceptions, util
 from mako.pygen import adjust_whitespace
 
 _regexp_cache = {}
 
+class PreprocessorCache(object):
+    """a bounded, process-wide cache of preprocessed template text,
+    keyed on a hash of the source along with the fingerprints of
+    the preprocessors applied to it.
+ 
+    ``hits`` and ``misses`` count lookups since the cache was created
+    or last cleared.  ``timings`` maps the name of each preprocessor
+    which has been run to a tuple of the number of times it was 
+    called and the total number of seconds spent in it.
+ 
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+ 
+    def clear(self):
+        self._results = util.LRUCache(self.capacity)
+        self.hits = self.misses = 0
+        self.timings = {}
+ 
+    def get(self, key):
+        try:
+            result = self._results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return result
+ 
+    def put(self, key, result):
+        self._results[key] = result
+ 
+    def record(self, name, elapsed):
+        calls, total = self.timings.get(name, (0, 0))
+        self.timings[name] = (calls + 1, total + elapsed)
+
+preprocessor_cache = PreprocessorCache(20)
+
+def preprocessor_fingerprint(preprocessor):
+    """return a tuple identifying the behavior of the given list of 
+    preprocessors, or None if it can't be identified.
+ 
+    a preprocessor is identified by its ``fingerprint`` attribute,
+    which it may declare to be any string which changes whenever 
+    its behavior does, such as a version number.  plain module-level 
+    functions without one are identified by their name along with
+    a hash of their code and default arguments, so that editing
+    the function changes its fingerprint; changes to the module
+    globals it refers to don't, however.
+ 
+    """
+    fingerprints = []
+    for fn in preprocessor:
+        fingerprint = getattr(fn, 'fingerprint', None)
+        if fingerprint is None:
+            if not isinstance(fn, types.FunctionType) or \
+                    fn.__name__ == '<lambda>' or \
+                    fn.func_closure is not None:
+                return None
+            fingerprint = "%s.%s:%s" % (fn.__module__, fn.__name__, 
+                                util.text_digest(_code_fingerprint(
+                                    fn.func_code) + 
+                                    repr(fn.func_defaults)))
+        fingerprints.append(fingerprint)
+    return tuple(fingerprints)
+
+def _code_fingerprint(code):
+    """return a string of the bytecode, constants and names of the 
+    given code object and the code objects nested within it, whose
+    reprs would include their addresses."""
+ 
+    parts = [repr(code.co_code), repr(code.co_names)]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(_code_fingerprint(const))
+        else:
+            parts.append(repr(const))
+    return "(%s)" % ", ".join(parts)
+
+def _preprocessor_name(fn):
+    name = getattr(fn, '__name__', None) or fn.__class__.__name__
+    module = getattr(fn, '__module__', None)
+    if module is None:
+        return name
+    return "%s.%s" % (module, name)
+
+# names of the slots of each Node class, for _copy_node().
+_slot_cache = {}
+
+def _copy_node(node):
+    """return a shallow copy of the given Node."""
+ 
+    cls = node.__class__
+    try:
+        slots = _slot_cache[cls]
+    except KeyError:
+        slots = _slot_cache[cls] = [name 
+                        for c in cls.__mro__ 
+                        for name in c.__dict__.get('__slots__', ())]
+    copy = object.__new__(cls)
+    for name in slots:
+        setattr(copy, name, getattr(node, name))
+    return copy
+
 class Lexer(object):
     def __init__(self, text, filename=None, 
                         disable_unicode=False, 
@@ -19,10 +124,11 @@ class Lexer(object):
         self.text = text
         self.filename = filename
         self.template = parsetree.TemplateNode(self.filename)
-        self.matched_lineno = 1
-        self.matched_charpos = 0
-        self.lineno = 1
+        self.matched_position = None
         self.match_position = 0
+        self.lookahead = 0
+        self.newlines = []
+        self.boundaries = []
         self.tag = []
         self.control_line = []
         self.disable_unicode = disable_unicode
@@ -40,6 +146,46 @@ class Lexer(object):
         else:
             self.preprocessor = preprocessor
  
+    @property
+    def lineno(self):
+        """the line number of the current text position."""
+
+        return bisect.bisect_left(self.newlines, self.match_position) + 1
+
+    @property
+    def matched_lineno(self):
+        """the line number of the start of the last match."""
+
+        if self.matched_position is None:
+            return 1
+        return bisect.bisect_left(self.newlines, self.matched_position) + 1
+
+    @property
+    def matched_charpos(self):
+        """the character position, within its line, of the start 
+        of the last match."""
+
+        if self.matched_position is None:
+            return 0
+        idx = bisect.bisect_left(self.newlines, self.matched_position)
+        if idx:
+            return self.matched_position - self.newlines[idx - 1]
+        else:
+            return self.matched_position + 1
+
+    def _index_newlines(self):
+        """build the sorted list of newline offsets within the text, 
+        from which line numbers and character positions are 
+        located."""
+
+        newlines = []
+        text = self.text
+        idx = text.find('\n')
+        while idx != -1:
+            newlines.append(idx)
+            idx = text.find('\n', idx + 1)
+        self.newlines = newlines
+
     @property
     def exception_kwargs(self):
         return {'source':self.text, 
@@ -64,29 +210,28 @@ class Lexer(object):
     def match_reg(self, reg):
         """match the given regular expression object to the current text position.
  
-        if a match occurs, update the current text and line position.
+        if a match occurs, update the current text position.  line 
+        numbers and character positions are derived from the 
+        text position as needed.
  
         """
 
         mp = self.match_position
 
-        match = reg.match(self.text, self.match_position)
+        match = reg.match(self.text, mp)
         if match:
             (start, end) = match.span()
+            # a match reaching the end of the text may 
+            # depend on there being nothing after it.
+            if end == self.textlength:
+                self.lookahead = end + 1
+            elif end > self.lookahead:
+                self.lookahead = end
             if end == start:
                 self.match_position = end + 1
             else:
                 self.match_position = end
-            self.matched_lineno = self.lineno
-            lines = re.findall(r"\n", self.text[mp:self.match_position])
-            cp = mp - 1
-            while (cp >= 0 and cp<self.textlength and self.text[cp] != '\n'):
-                cp -=1
-            self.matched_charpos = mp - cp
-            self.lineno += len(lines)
-            #print "MATCHED:", match.group(0), "LINE START:", 
-            # self.matched_lineno, "LINE END:", self.lineno
-        #print "MATCH:", regexp, "\n", self.text[mp : mp + 15], (match and "TRUE" or "FALSE")
+            self.matched_position = mp
         return match
  
     def parse_until_text(self, *text):
@@ -95,6 +240,10 @@ class Lexer(object):
             match = self.match(r'#.*\n')
             if match:
                 continue
+            elif self.text.startswith('#', self.match_position):
+                # no newline ends the comment; the rest of the 
+                # text was searched for one.
+                self.lookahead = self.textlength + 1
             match = self.match(r'(\"\"\"|\'\'\'|\"|\')')
             if match:
                 m = self.match(r'.*?%s' % match.group(1), re.S)
@@ -118,10 +267,9 @@ class Lexer(object):
                                     **self.exception_kwargs)
  
     def append_node(self, nodecls, *args, **kwargs):
-        kwargs.setdefault('source', self.text)
+        kwargs.setdefault('source_file', self.source_file)
         kwargs.setdefault('lineno', self.matched_lineno)
         kwargs.setdefault('pos', self.matched_charpos)
-        kwargs['filename'] = self.filename
         node = nodecls(*args, **kwargs)
         if len(self.tag):
             self.tag[-1].nodes.append(node)
@@ -145,29 +293,60 @@ class Lexer(object):
 
     _coding_re = re.compile(r'#.*coding[:=]\s*([-\w.]+).*\r?\n')
 
+    # leading characters of each construct, in the order 
+    # in which parse() tries the corresponding match_XXX() method
+    _token_re = re.compile(r"""
+                (\Z)                          # end of string
+                |
+                (\${)                         # an expression
+                |
+                (^[\t ]*(?:%(?!%)|\#\#))       # control line or line-based comment
+                |
+                (<%doc>)                      # multiline comment
+                |
+                (<%[\w\.\:])                  # tag start
+                |
+                (</%)                         # tag end
+                |
+                (<%)                          # python block
+                """, re.M | re.X)
+
     def decode_raw_stream(self, text, decode_raw, known_encoding, filename):
         """given string/unicode or bytes/string, determine encoding
            from magic encoding comment, return body as unicode
            or raw if decode_raw=False
-
+ 
+           the bytes may also be given as a file object, which 
+           is memory mapped where possible, or as a memory map; 
+           these are decoded in place without first being copied 
+           into a string.
+ 
         """
         if isinstance(text, unicode):
             m = self._coding_re.match(text)
             encoding = m and m.group(1) or known_encoding or 'ascii'
             return encoding, text
 
-        if text.startswith(codecs.BOM_UTF8):
-            text = text[len(codecs.BOM_UTF8):]
+        if hasattr(text, 'read') and not util.is_mapped(text):
+            text = util.map_file(text)
+            if isinstance(text, unicode):
+                return self.decode_raw_stream(text, decode_raw, 
+                                        known_encoding, filename)
+
+        # the magic encoding comment can only be on the first line.
+        if text[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+            offset = len(codecs.BOM_UTF8)
             parsed_encoding = 'utf-8'
-            m = self._coding_re.match(text.decode('utf-8', 'ignore'))
+            m = self._coding_re.match(self._first_line(text, offset))
             if m is not None and m.group(1) != 'utf-8':
                 raise exceptions.CompileException(
                                 "Found utf-8 BOM in file, with conflicting "
                                 "magic encoding comment of '%s'" % m.group(1), 
-                                text.decode('utf-8', 'ignore'), 
+                                text[offset:].decode('utf-8', 'ignore'), 
                                 0, 0, filename)
         else:
-            m = self._coding_re.match(text.decode('utf-8', 'ignore'))
+            offset = 0
+            m = self._coding_re.match(self._first_line(text, offset))
             if m:
                 parsed_encoding = m.group(1)
             else:
@@ -175,55 +354,122 @@ class Lexer(object):
 
         if decode_raw:
             try:
-                text = text.decode(parsed_encoding)
+                if isinstance(text, str):
+                    text = text[offset:].decode(parsed_encoding)
+                else:
+                    text = codecs.getdecoder(parsed_encoding)(
+                                util.buffer_view(text, offset))[0]
             except UnicodeDecodeError, e:
                 raise exceptions.CompileException(
                                 "Unicode decode operation of encoding '%s' failed" %
                                 parsed_encoding, 
-                                text.decode('utf-8', 'ignore'), 
+                                text[offset:].decode('utf-8', 'ignore'), 
                                 0, 0, filename)
+        elif offset or not isinstance(text, str):
+            text = text[offset:]
 
         return parsed_encoding, text
 
-    def parse(self):
+    def _first_line(self, text, offset):
+        """return the line of raw text starting at the given offset,
+        including its newline, decoded for matching against 
+        _coding_re."""
+ 
+        end = text.find('\n'.encode('ascii'), offset)
+        return text[offset:end + 1].decode('utf-8', 'ignore')
+
+    def parse(self, previous=None):
+        """parse the text, returning the root TemplateNode.
+ 
+        previous, if given, is a Lexer which has parsed an earlier
+        version of the same template.  the top-level nodes of the 
+        regions at the start and end of the text which are unchanged
+        since then are copied from its parse tree, and only the 
+        changed region in between is lexed.
+ 
+        """
         self.encoding, self.text = self.decode_raw_stream(self.text, 
                                         not self.disable_unicode, 
                                         self.encoding,
                                         self.filename,)
 
-        for preproc in self.preprocessor:
-            self.text = preproc(self.text)
+        if self.preprocessor:
+            self.text = self.preprocess(self.text)
  
+        self.source_file = parsetree.SourceFile(self.text, self.filename)
+        self._index_newlines()
+        self.textlength = len(self.text)
+
         # push the match marker past the 
         # encoding comment.
         self.match_reg(self._coding_re)
  
-        self.textlength = len(self.text)
- 
+        if previous is not None:
+            resume = self._resume(previous)
+        else:
+            resume = None
+
+        matchers = (
+            self.match_end,
+            self.match_expression,
+            self.match_control_line,
+            self.match_comment,
+            self.match_tag_start,
+            self.match_tag_end,
+            self.match_python_block,
+            self.match_text
+        )
+        token_re = self._token_re
+        boundaries = self.boundaries
+        nodes = self.template.nodes
+        after_text = False
         while (True):
             if self.match_position > self.textlength: 
                 break
  
-            if self.match_end():
-                break
-            if self.match_expression():
-                continue
-            if self.match_control_line():
-                continue
-            if self.match_comment():
-                continue
-            if self.match_tag_start(): 
-                continue
-            if self.match_tag_end():
-                continue
-            if self.match_python_block():
-                continue
-            if self.match_text(): 
-                continue
- 
-            if self.match_position > self.textlength: 
+            # note the positions at which top-level nodes begin 
+            # with no tags or control lines open; these are the
+            # places at which a later parse may resume or stop.
+            clean = not self.tag and not self.control_line
+            if clean:
+                if resume and self.match_position in resume:
+                    self._copy_remaining(previous, 
+                                        resume[self.match_position], 
+                                        not after_text)
+                    break
+                count = len(nodes)
+                position = self.match_position
+                lookahead = self.lookahead
+
+            # a single pass of the token regexp locates the first
+            # matcher which could possibly apply at this position;
+            # all the matchers before it would fail.  the remaining
+            # matchers are tried in their usual order, since the token 
+            # regexp only checks the leading characters of each construct.
+            token = token_re.match(self.text, self.match_position)
+            if token:
+                start = token.lastindex - 1
+            else:
+                start = len(matchers) - 1
+
+            for idx in xrange(start, len(matchers)):
+                if matchers[idx]():
+                    break
+                # a failed match may have examined any of the 
+                # remaining text.
+                self.lookahead = self.textlength + 1
+            else:
+                if self.match_position > self.textlength: 
+                    break
+                raise exceptions.CompileException("assertion failed")
+
+            if clean and len(nodes) > count:
+                boundaries.append(
+                        (position, count, not after_text, lookahead))
+            after_text = idx == len(matchers) - 1
+
+            if idx == 0:
                 break
-            raise exceptions.CompileException("assertion failed")
  
         if len(self.tag):
             raise exceptions.SyntaxException("Unclosed tag: <%%%s>" % 
@@ -237,6 +483,139 @@ class Lexer(object):
                                             self.control_line[-1].pos, self.filename)
         return self.template
 
+    def preprocess(self, text):
+        """apply the preprocessors to the given text, recording the
+        time spent in each, or retrieve the result from 
+        preprocessor_cache if the preprocessors can be identified."""
+ 
+        fingerprint = preprocessor_fingerprint(self.preprocessor)
+        if fingerprint is not None:
+            key = (type(text), util.text_digest(text), fingerprint)
+            result = preprocessor_cache.get(key)
+            if result is not None:
+                return result
+        for preproc in self.preprocessor:
+            start = util.time_func()
+            text = preproc(text)
+            preprocessor_cache.record(_preprocessor_name(preproc), 
+                                        util.time_func() - start)
+        if fingerprint is not None:
+            preprocessor_cache.put(key, text)
+        return text
+
+    def _resume(self, previous):
+        """prepare to parse the text starting from the last position
+        in the unchanged leading region of the text at which the
+        previous Lexer began a top-level node, copying the nodes
+        before it.
+ 
+        returns a dictionary of the positions in the unchanged 
+        trailing region of the text at which parsing can stop,
+        mapped to the previous boundary at each.
+ 
+        """
+        old, new = previous.text, self.text
+        if type(old) is not type(new) or not previous.boundaries:
+            return None
+
+        # length of the common prefix and suffix, found by 
+        # bisection so that the comparisons are done on slices.
+        lo, hi = 0, min(len(old), len(new))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if old[lo:mid] == new[lo:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        prefix = lo
+        lo, hi = 0, min(len(old), len(new)) - prefix
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if old[len(old) - mid:len(old) - lo] == \
+                    new[len(new) - mid:len(new) - lo]:
+                lo = mid
+            else:
+                hi = mid - 1
+        suffix_start = len(new) - lo
+        delta = len(new) - len(old)
+
+        # the extent of plain text depends on what follows it, so
+        # parsing can't start directly after some; nor after any 
+        # node whose lexing looked at text from the changed region 
+        # onwards, such as a comment within an expression.
+        for i in xrange(len(previous.boundaries) - 1, -1, -1):
+            position, index, after_node, lookahead = \
+                                            previous.boundaries[i]
+            if position <= prefix and lookahead <= prefix and \
+                    position >= self.match_position and after_node:
+                self.template.nodes.extend(self._copy_nodes(
+                                previous.template.nodes[:index], 0, 0))
+                self.boundaries.extend(previous.boundaries[:i])
+                self.match_position = position
+                self.lookahead = lookahead
+                break
+
+        # parsing can stop at a boundary in the unchanged trailing
+        # region when the line it's on begins within that region as 
+        # well, so that the text before it doesn't affect its nodes.
+        resume = {}
+        for i, (position, index, after_node, lookahead) in \
+                                    enumerate(previous.boundaries):
+            newpos = position + delta
+            if newpos <= suffix_start:
+                continue
+            idx = bisect.bisect_left(self.newlines, newpos)
+            if idx and self.newlines[idx - 1] >= suffix_start:
+                resume[newpos] = i
+        return resume
+
+    def _copy_remaining(self, previous, i, after_node):
+        """copy the top-level nodes of the previous Lexer from its 
+        boundary i onwards, which lie in the unchanged trailing 
+        region of the text."""
+ 
+        position, index = previous.boundaries[i][0:2]
+        newpos = self.match_position
+        delta = newpos - position
+        line_delta = bisect.bisect_left(self.newlines, newpos) - \
+                    bisect.bisect_left(previous.newlines, position)
+        count = len(self.template.nodes)
+        self.template.nodes.extend(
+                        self._copy_nodes(previous.template.nodes[index:], 
+                                            delta, line_delta))
+        self.boundaries.append((newpos, count, after_node, self.lookahead))
+        for position, idx, after_node, lookahead in \
+                                    previous.boundaries[i + 1:]:
+            self.boundaries.append(
+                        (position + delta, idx - index + count, after_node, 
+                        max(lookahead + delta, self.lookahead)))
+        self.lookahead = max(previous.lookahead + delta, self.lookahead)
+        self.match_position = self.textlength + 1
+
+    def _copy_nodes(self, nodes, delta, line_delta):
+        """return copies of the given nodes from a previous parse and
+        their descendants, moved by the given number of characters
+        and lines and referring to this Lexer's source."""
+ 
+        result = []
+        stack = [(nodes, result, None)]
+        while stack:
+            nodes, copies, parent = stack.pop()
+            for node in nodes:
+                node = _copy_node(node)
+                node.source_file = self.source_file
+                node.lineno += line_delta
+                if isinstance(node, parsetree.Text) and \
+                        node.start is not None:
+                    node.start += delta
+                    node.end += delta
+                elif isinstance(node, parsetree.Tag):
+                    node.parent = parent
+                    children, node.nodes = node.nodes, []
+                    stack.append((children, node.nodes, node))
+                copies.append(node)
+        return result
+
     def match_tag_start(self):
         match = self.match(r'''
             \<%     # opening tag
@@ -274,7 +653,8 @@ class Lexer(object):
                                             "Unclosed tag: <%%%s>" % 
                                             self.tag[-1].keyword, 
                                             **self.exception_kwargs)
-                    self.append_node(parsetree.Text, match.group(1))
+                    self.append_node(parsetree.Text, None, 
+                                        span=match.span(1))
                     return self.match_tag_end()
             return True
         else: 
@@ -311,28 +691,41 @@ class Lexer(object):
  
     def match_text(self):
         match = self.match(r"""
-                (.*?)         # anything, followed by:
                 (
-                 (?<=\n)(?=[ \t]*(?=%|\#\#)) # an eval or line-based 
-                                             # comment preceded by a 
-                                             # consumed newline and whitespace
-                 |
-                 (?=\${)      # an expression
-                 |
-                 (?=\#\*)     # multiline comment
-                 |
-                 (?=</?[%&])  # a substitution or block or call start or end
-                              # - don't consume
-                 |
-                 (\\\r?\n)    # an escaped newline  - throw away
+                 (?<=\n)(?=[ \t]*(?:%|\#\#))  # nothing, when at an eval or 
+                                              # line-based comment preceded 
+                                              # by a consumed newline and 
+                                              # whitespace
                  |
-                 \Z           # end of string
-                )""", re.X | re.S)
+                 (?:
+                  [^\n$\#<\\]+               # anything that can't 
+                                              # start a construct,
+                  |
+                  \n(?![ \t]*(?:%|\#\#))     # a newline not followed by an
+                                              # eval or line-based comment
+                  |
+                  \$(?!{)                     # a $ not starting an expression
+                  |
+                  \#(?!\*)                    # a # not starting a multiline
+                                              # comment
+                  |
+                  <(?!/?[%&])                 # a < not starting a 
+                                              # substitution, block or call 
+                                              # start or end
+                  |
+                  \\(?!\r?\n)                 # a backslash not escaping a
+                                              # newline
+                 )*
+                 (?:\n(?=[ \t]*(?:%|\#\#)))?   # the newline preceding an eval 
+                                              # or line-based comment
+                )
+                (\\\r?\n)?                    # an escaped newline - throw away
+                """, re.X)
  
         if match:
-            text = match.group(1)
-            if text:
-                self.append_node(parsetree.Text, text)
+            start, end = match.span(1)
+            if end > start:
+                self.append_node(parsetree.Text, None, span=(start, end))
             return True
         else:
             return False
@@ -163,9 +163,13 @@ class TemplateLookup(TemplateCollection):
                         default_filters=None, 
                         buffer_filters=(), 
                         strict_undefined=False,
+                        bind_builtins=False,
+                        lazy_declares=False,
                         imports=None, 
                         input_encoding=None, 
-                        preprocessor=None):
+                        preprocessor=None,
+                        parsetree_cache=False,
+                        incremental_lexing=False):
  
         self.directories = [posixpath.normpath(d) for d in
                             util.to_list(directories, ())
@@ -199,8 +203,12 @@ class TemplateLookup(TemplateCollection):
             'default_filters':default_filters, 
             'buffer_filters':buffer_filters, 
             'strict_undefined':strict_undefined,
+            'bind_builtins':bind_builtins,
+            'lazy_declares':lazy_declares,
             'imports':imports, 
-            'preprocessor':preprocessor}
+            'preprocessor':preprocessor,
+            'parsetree_cache':parsetree_cache,
+            'incremental_lexing':incremental_lexing}
 
         if collection_size == -1:
             self._collection = {}
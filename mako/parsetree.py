@@ -7,15 +7,41 @@
 """defines the parse tree components for Mako templates."""
 
 from mako import exceptions, ast, util, filters
-import re
+import re, types
 
-class Node(object):
-    """base class for a Node in the parse tree."""
-    def __init__(self, source, lineno, pos, filename):
+class SourceFile(object):
+    """the source text and filename of a template, shared by
+    every Node parsed from it."""
+ 
+    __slots__ = ('source', 'filename')
+ 
+    def __init__(self, source, filename):
         self.source = source
+        self.filename = filename
+
+class Node(object):
+    """base class for a Node in the parse tree.
+ 
+    nodes use ``__slots__``, as a large template produces many 
+    thousands of them; the source and filename are held by a 
+    :class:`.SourceFile` shared among all nodes of a template.
+ 
+    """
+ 
+    __slots__ = ('source_file', 'lineno', 'pos')
+ 
+    def __init__(self, source_file, lineno, pos):
+        self.source_file = source_file
         self.lineno = lineno
         self.pos = pos
-        self.filename = filename
+ 
+    @property
+    def source(self):
+        return self.source_file.source
+ 
+    @property
+    def filename(self):
+        return self.source_file.filename
  
     @property
     def exception_kwargs(self):
@@ -26,17 +52,43 @@ class Node(object):
         return []
  
     def accept_visitor(self, visitor):
-        def traverse(node):
-            for n in node.get_children():
-                n.accept_visitor(visitor)
-        method = getattr(visitor, "visit" + self.__class__.__name__, traverse)
-        method(self)
+        """visit this node with the given visitor.
+ 
+        the visitor's ``visit<classname>()`` method is called with 
+        the node; the children of a node which has no such method 
+        are visited in turn.  a visit method may also be a generator, 
+        yielding the nodes it wants visited before it resumes.
+ 
+        traversal uses an explicit stack rather than recursion, so
+        deeply nested templates don't consume the Python stack.
+ 
+        """
+        stack = [iter((self,))]
+        while stack:
+            for node in stack[-1]:
+                method = getattr(visitor, 
+                                "visit" + node.__class__.__name__, None)
+                if method is None:
+                    children = node.get_children()
+                    if children:
+                        stack.append(iter(children))
+                        break
+                else:
+                    result = method(node)
+                    if result is not None and \
+                            type(result) is types.GeneratorType:
+                        stack.append(result)
+                        break
+            else:
+                stack.pop()
 
 class TemplateNode(Node):
     """a 'container' node that stores the overall collection of nodes."""
  
+    __slots__ = ('nodes', 'page_attributes')
+ 
     def __init__(self, filename):
-        super(TemplateNode, self).__init__('', 0, 0, filename)
+        super(TemplateNode, self).__init__(SourceFile('', filename), 0, 0)
         self.nodes = []
         self.page_attributes = {}
  
@@ -59,6 +111,9 @@ class ControlLine(Node):
  
     """
 
+    __slots__ = ('text', 'keyword', 'isend', 'is_primary', 
+                '_declared_identifiers', '_undeclared_identifiers')
+
     def __init__(self, keyword, isend, text, **kwargs):
         super(ControlLine, self).__init__(**kwargs)
         self.text = text
@@ -98,11 +153,35 @@ class ControlLine(Node):
         )
 
 class Text(Node):
-    """defines plain text in the template."""
+    """defines plain text in the template.
+ 
+    the lexer gives the text as a ``(start, end)`` span of the 
+    template source in place of the content, which is then sliced 
+    from the source when needed, so that the static text of a 
+    large template isn't held a second time by its Text nodes.
+ 
+    """
  
-    def __init__(self, content, **kwargs):
+    __slots__ = ('_content', 'start', 'end')
+ 
+    def __init__(self, content, span=None, **kwargs):
         super(Text, self).__init__(**kwargs)
-        self.content = content
+        self._content = content
+        if span is None:
+            self.start = self.end = None
+        else:
+            self.start, self.end = span
+ 
+    def _get_content(self):
+        if self.start is None:
+            return self._content
+        return self.source_file.source[self.start:self.end]
+ 
+    def _set_content(self, content):
+        self._content = content
+        self.start = self.end = None
+ 
+    content = property(_get_content, _set_content)
  
     def __repr__(self):
         return "Text(%r, %r)" % (self.content, (self.lineno, self.pos))
@@ -124,6 +203,8 @@ class Code(Node):
  
     """
 
+    __slots__ = ('text', 'ismodule', 'code')
+
     def __init__(self, text, ismodule, **kwargs):
         super(Code, self).__init__(**kwargs)
         self.text = text
@@ -150,6 +231,8 @@ class Comment(Node):
  
     """
  
+    __slots__ = ('text',)
+ 
     def __init__(self, text, **kwargs):
         super(Comment, self).__init__(**kwargs)
         self.text = text
@@ -164,6 +247,8 @@ class Expression(Node):
  
     """
  
+    __slots__ = ('text', 'escapes', 'escapes_code', 'code')
+ 
     def __init__(self, text, escapes, **kwargs):
         super(Expression, self).__init__(**kwargs)
         self.text = text
@@ -211,10 +296,10 @@ class _TagMeta(type):
         except KeyError:
             raise exceptions.CompileException(
                 "No such tag: '%s'" % keyword, 
-                source=kwargs['source'], 
+                source=kwargs['source_file'].source, 
                 lineno=kwargs['lineno'], 
                 pos=kwargs['pos'], 
-                filename=kwargs['filename']
+                filename=kwargs['source_file'].filename
             )
         return type.__call__(cls, keyword, attributes, **kwargs)
  
@@ -231,6 +316,8 @@ class Tag(Node):
  
     __metaclass__ = _TagMeta
     __keyword__ = None
+    __slots__ = ('keyword', 'attributes', 'parsed_attributes', 
+                'expression_undeclared_identifiers', 'parent', 'nodes')
  
     def __init__(self, keyword, attributes, expressions, 
                         nonexpressions, required, **kwargs):
@@ -250,7 +337,8 @@ class Tag(Node):
          attributes, which cannot contain embedded expressions
  
         :param \**kwargs:
-         other arguments passed to the Node superclass (lineno, pos)
+         other arguments passed to the Node superclass (source_file, 
+         lineno, pos)
  
         """
         super(Tag, self).__init__(**kwargs)
@@ -326,6 +414,7 @@ class Tag(Node):
  
 class IncludeTag(Tag):
     __keyword__ = 'include'
+    __slots__ = ('page_args',)
 
     def __init__(self, keyword, attributes, **kwargs):
         super(IncludeTag, self).__init__(
@@ -349,6 +438,7 @@ class IncludeTag(Tag):
  
 class NamespaceTag(Tag):
     __keyword__ = 'namespace'
+    __slots__ = ('name',)
 
     def __init__(self, keyword, attributes, **kwargs):
         super(NamespaceTag, self).__init__(
@@ -375,6 +465,7 @@ class NamespaceTag(Tag):
 
 class TextTag(Tag):
     __keyword__ = 'text'
+    __slots__ = ('filter_args',)
 
     def __init__(self, keyword, attributes, **kwargs):
         super(TextTag, self).__init__(
@@ -387,9 +478,10 @@ class TextTag(Tag):
  
 class DefTag(Tag):
     __keyword__ = 'def'
+    __slots__ = ('function_decl', 'name', 'decorator', 'filter_args')
 
     def __init__(self, keyword, attributes, **kwargs):
-        expressions = ['buffered', 'cached'] + [
+        expressions = ['buffered', 'cached', 'inline'] + [
                 c for c in attributes if c.startswith('cache_')]
 
 
@@ -438,6 +530,7 @@ class DefTag(Tag):
 
 class BlockTag(Tag):
     __keyword__ = 'block'
+    __slots__ = ('body_decl', 'name', 'decorator', 'filter_args')
 
     def __init__(self, keyword, attributes, **kwargs):
         expressions = ['buffered', 'cached', 'args'] + [
@@ -491,6 +584,7 @@ class BlockTag(Tag):
 
 class CallTag(Tag):
     __keyword__ = 'call'
+    __slots__ = ('expression', 'code', 'body_decl')
 
     def __init__(self, keyword, attributes, **kwargs):
         super(CallTag, self).__init__(keyword, attributes, 
@@ -508,6 +602,7 @@ class CallTag(Tag):
                     difference(self.code.declared_identifiers)
 
 class CallNamespaceTag(Tag):
+    __slots__ = ('expression', 'code', 'body_decl')
 
     def __init__(self, namespace, defname, attributes, **kwargs):
         super(CallNamespaceTag, self).__init__(
@@ -539,6 +634,7 @@ class CallNamespaceTag(Tag):
 
 class InheritTag(Tag):
     __keyword__ = 'inherit'
+    __slots__ = ()
 
     def __init__(self, keyword, attributes, **kwargs):
         super(InheritTag, self).__init__(
@@ -547,6 +643,7 @@ class InheritTag(Tag):
 
 class PageTag(Tag):
     __keyword__ = 'page'
+    __slots__ = ('body_decl', 'filter_args')
 
     def __init__(self, keyword, attributes, **kwargs):
         expressions =   ['cached', 'args', 'expression_filter'] + [
@@ -10,6 +10,18 @@ import re, string
 from StringIO import StringIO
 from mako import exceptions
 
+# the patterns with which lines of python are examined
+_blank_or_comment = re.compile(r"^\s*(?:#|$)")
+_block_start = re.compile(r":[ \t]*(?:#.*)?$")
+_compound_keyword = re.compile(r"^\s*(if|try|elif|while|for)")
+_block_keyword = re.compile(r"^\s*(def|class|else|elif|except|finally)")
+_unindentor = re.compile(r"^\s*(else|elif|except|finally).*\:")
+_triple_quote = re.compile(r"\"\"\"|\'\'\'")
+_triple_quote_or_comment = re.compile(r"\"\"\"|\'\'\'|#")
+_code_line = re.compile(r"^[ \t]*[^# \t]")
+_margin = re.compile(r"^([ \t]*)")
+_newline = re.compile(r'\r?\n')
+
 class PythonPrinter(object):
     def __init__(self, stream):
         # indentation counter
@@ -33,10 +45,40 @@ class PythonPrinter(object):
  
         self.in_indent_lines = False
  
+        # the number of lines written to the stream
+        self.lineno = 0
+
+        # a list of the line numbers of the template source which
+        # the lines written were generated from, as a pair of lists: 
+        # the first line written for each source line, and the
+        # source line.
+        self.source_map = ([], [])
+
         self._reset_multi_line_flags()
 
     def write(self, text):
+        self.lineno += text.count("\n")
         self.stream.write(text)
+
+    def start_source(self, lineno):
+        """mark the lines of python which follow as generated from the
+        given line of template source."""
+
+        if not self.in_indent_lines:
+            self._flush_adjusted_lines()
+            self.in_indent_lines = True
+
+        lines, source_lines = self.source_map
+        if source_lines and source_lines[-1] == lineno:
+            return
+        if lines and lines[-1] == self.lineno + 1:
+            # nothing was written for the previous source line
+            lines.pop()
+            source_lines.pop()
+            if source_lines and source_lines[-1] == lineno:
+                return
+        lines.append(self.lineno + 1)
+        source_lines.append(lineno)
  
     def write_indented_block(self, block):
         """print a line or lines of python which already contain indentation.
@@ -44,13 +86,29 @@ class PythonPrinter(object):
         The indentation of the total block of lines will be adjusted to that of
         the current indent level.""" 
         self.in_indent_lines = False
-        for l in re.split(r'\r?\n', block):
-            self.line_buffer.append(l)
+        self.line_buffer.extend(_newline.split(block))
  
     def writelines(self, *lines):
         """print a series of lines of python."""
         for line in lines:
             self.writeline(line)
+
+    def writeline_plain(self, line):
+        """print a line of python which neither begins nor ends a
+        block, such as a simple statement or a comment, at the
+        current indent level.
+
+        unlike writeline(), the content of the line isn't examined;
+        this is for the lines which the caller knows to be plain.
+
+        """
+
+        if not self.in_indent_lines:
+            self._flush_adjusted_lines()
+            self.in_indent_lines = True
+
+        self.lineno += line.count("\n") + 1
+        self.stream.write(self.indentstring * self.indent + line + "\n")
  
     def writeline(self, line):
         """print a line of python, indenting it according to the current
@@ -65,21 +123,15 @@ class PythonPrinter(object):
             self._flush_adjusted_lines()
             self.in_indent_lines = True
 
-        decreased_indent = False
- 
-        if (line is None or 
-            re.match(r"^\s*#",line) or
-            re.match(r"^\s*$", line)
-            ):
+        if line is None or _blank_or_comment.match(line):
             hastext = False
         else:
             hastext = True
 
-        is_comment = line and len(line) and line[0] == '#'
+        is_comment = line and line[0] == '#'
  
         # see if this line should decrease the indentation level
-        if (not decreased_indent and 
-            not is_comment and 
+        if (not is_comment and
             (not hastext or self._is_unindentor(line))
             ):
  
@@ -97,18 +149,19 @@ class PythonPrinter(object):
             return
  
         # write the line
-        self.stream.write(self._indent_line(line) + "\n")
+        self.lineno += line.count("\n") + 1
+        self.stream.write(self.indentstring * self.indent + line + "\n")
  
         # see if this line should increase the indentation level.
         # note that a line can both decrase (before printing) and 
         # then increase (after printing) the indentation level.
 
-        if re.search(r":[ \t]*(?:#.*)?$", line):
+        if ':' in line and _block_start.search(line):
             # increment indentation count, and also
             # keep track of what the keyword was that indented us,
             # if it is a python compound statement keyword
             # where we might have to look for an "unindent" keyword
-            match = re.match(r"^\s*(if|try|elif|while|for)", line)
+            match = _compound_keyword.match(line)
             if match:
                 # its a "compound" keyword, so we will check for "unindentors"
                 indentor = match.group(1)
@@ -119,7 +172,7 @@ class PythonPrinter(object):
                 # its not a "compound" keyword.  but lets also
                 # test for valid Python keywords that might be indenting us,
                 # else assume its a non-indenting line
-                m2 = re.match(r"^\s*(def|class|else|elif|except|finally)", line)
+                m2 = _block_keyword.match(line)
                 if m2:
                     self.indent += 1
                     self.indent_detail.append(indentor)
@@ -147,7 +200,7 @@ class PythonPrinter(object):
  
         # if the current line doesnt have one of the "unindentor" keywords,
         # return False
-        match = re.match(r"^\s*(else|elif|except|finally).*\:", line)
+        match = _unindentor.match(line)
         if not match: 
             return False
  
@@ -175,10 +228,12 @@ class PythonPrinter(object):
         """indent the given line according to the current indent level.
  
         stripspace is a string of space that will be truncated from the
-        start of the line before indenting."""
+        start of the line before indenting.  a line which doesn't start
+        with it is returned as is."""
 
-        return re.sub(r"^%s" % stripspace, self.indentstring
-                      * self.indent, line)
+        if not line.startswith(stripspace):
+            return line
+        return self.indentstring * self.indent + line[len(stripspace):]
 
     def _reset_multi_line_flags(self):
         """reset the flags which would indicate we are in a backslashed
@@ -198,14 +253,12 @@ class PythonPrinter(object):
  
         current_state = (self.backslashed or self.triplequoted) 
  
-        if re.search(r"\\$", line):
-            self.backslashed = True
-        else:
-            self.backslashed = False
+        self.backslashed = line.endswith('\\')
  
-        triples = len(re.findall(r"\"\"\"|\'\'\'", line))
-        if triples == 1 or triples % 2 != 0:
-            self.triplequoted = not self.triplequoted
+        if '"""' in line or "'''" in line:
+            triples = len(_triple_quote.findall(line))
+            if triples % 2 != 0:
+                self.triplequoted = not self.triplequoted
  
         return current_state
 
@@ -213,14 +266,21 @@ class PythonPrinter(object):
         stripspace = None
         self._reset_multi_line_flags()
  
+        self.lineno += len(self.line_buffer)
         for entry in self.line_buffer:
             if self._in_multi_line(entry):
                 self.stream.write(entry + "\n")
             else:
                 entry = entry.expandtabs()
-                if stripspace is None and re.search(r"^[ \t]*[^# \t]", entry):
-                    stripspace = re.match(r"^([ \t]*)", entry).group(1)
-                self.stream.write(self._indent_line(entry, stripspace) + "\n")
+                if stripspace is None and _code_line.match(entry):
+                    stripspace = _margin.match(entry).group(1)
+                if stripspace is None:
+                    # a blank or comment line ahead of the first
+                    # line of code is written as is
+                    self.stream.write(entry + "\n")
+                else:
+                    self.stream.write(
+                            self._indent_line(entry, stripspace) + "\n")
  
         self.line_buffer = []
         self._reset_multi_line_flags()
@@ -235,51 +295,38 @@ def adjust_whitespace(text):
     def in_multi_line(line):
         start_state = (state[backslashed] or state[triplequoted])
  
-        if re.search(r"\\$", line):
-            state[backslashed] = True
-        else:
-            state[backslashed] = False
+        state[backslashed] = line.endswith('\\')
  
-        def match(reg, t):
-            m = re.match(reg, t)
-            if m:
-                return m, t[len(m.group(0)):]
-            else:
-                return None, t
- 
-        while line:
+        # step from each triple quote to the next, until the
+        # end of the line or a comment outside of a string
+        pos = 0
+        while True:
             if state[triplequoted]:
-                m, line = match(r"%s" % state[triplequoted], line)
-                if m:
-                    state[triplequoted] = False
-                else:
-                    m, line = match(r".*?(?=%s|$)" % state[triplequoted], line)
+                end = line.find(state[triplequoted], pos)
+                if end == -1:
+                    break
+                state[triplequoted] = False
+                pos = end + 3
             else:
-                m, line = match(r'#', line)
-                if m:
-                    return start_state
- 
-                m, line = match(r"\"\"\"|\'\'\'", line)
-                if m:
-                    state[triplequoted] = m.group(0)
-                    continue
-
-                m, line = match(r".*?(?=\"\"\"|\'\'\'|#|$)", line)
+                m = _triple_quote_or_comment.search(line, pos)
+                if m is None or m.group(0) == '#':
+                    break
+                state[triplequoted] = m.group(0)
+                pos = m.end()
  
         return start_state
 
-    def _indent_line(line, stripspace = ''):
-        return re.sub(r"^%s" % stripspace, '', line)
-
     lines = []
     stripspace = None
 
-    for line in re.split(r'\r?\n', text):
+    for line in _newline.split(text):
         if in_multi_line(line):
             lines.append(line)
         else:
             line = line.expandtabs()
-            if stripspace is None and re.search(r"^[ \t]*[^# \t]", line):
-                stripspace = re.match(r"^([ \t]*)", line).group(1)
-            lines.append(_indent_line(line, stripspace))
+            if stripspace is None and _code_line.match(line):
+                stripspace = _margin.match(line).group(1)
+            if stripspace and line.startswith(stripspace):
+                line = line[len(stripspace):]
+            lines.append(line)
     return "\n".join(lines)
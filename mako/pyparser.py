@@ -38,6 +38,7 @@ except ImportError:
     _ast = None
     from compiler import parse as compiler_parse
     from compiler import visitor
+    from compiler import ast as compiler_ast
 
 
 def parse(code, mode='exec', **exception_kwargs):
@@ -60,6 +61,101 @@ def parse(code, mode='exec', **exception_kwargs):
                     ), **exception_kwargs)
 
 
+class NotConstant(Exception):
+    """raised by ConstantEvaluator for an expression whose value 
+    can't be computed at compile time."""
+
+
+class _ConstantOps(object):
+    """the operations of ConstantEvaluator, shared by both 
+    of its implementations."""
+
+    # operators which give the same result at compile time as at 
+    # runtime.  division isn't among them, as its result depends on 
+    # the __future__ imports of the module, nor is the '%' operator, 
+    # whose format string can ask for a result of any size.
+    binary_ops = {
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+    }
+    unary_ops = {
+        '+': operator.pos,
+        '-': operator.neg,
+        '~': operator.invert,
+        'not': operator.not_,
+    }
+    compare_ops = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+        'in': lambda a, b: a in b,
+        'not in': lambda a, b: a not in b,
+    }
+    names = {'True': True, 'False': False, 'None': None}
+
+    def __init__(self, functions, limit):
+        self.functions = functions
+        self.limit = limit
+
+    def sized(self, value):
+        if isinstance(value, (basestring, tuple, list)) and \
+                len(value) > self.limit:
+            raise NotConstant()
+        return value
+
+    def name(self, name):
+        try:
+            return self.names[name]
+        except KeyError:
+            raise NotConstant()
+
+    def binary(self, op, left, right):
+        if op not in self.binary_ops:
+            raise NotConstant()
+        if op == '*':
+            # check the size of a repeated sequence before building it
+            for seq, count in ((left, right), (right, left)):
+                if isinstance(seq, (basestring, tuple, list)) and \
+                        isinstance(count, (int, long)) and \
+                        len(seq) * count > self.limit:
+                    raise NotConstant()
+        return self.sized(self.binary_ops[op](left, right))
+
+    def unary(self, op, operand):
+        if op not in self.unary_ops:
+            raise NotConstant()
+        return self.unary_ops[op](operand)
+
+    def compare(self, left, ops):
+        for op, right in ops:
+            if op not in self.compare_ops:
+                raise NotConstant()
+            if not self.compare_ops[op](left, right):
+                return False
+            left = right
+        return True
+
+    def boolean(self, op, values):
+        for value in values[:-1]:
+            if (op == 'and') != bool(value):
+                return value
+        return values[-1]
+
+    def optional(self, node):
+        if node is None:
+            return None
+        return self.visit(node)
+
+    def call(self, name, args):
+        if name not in self.functions:
+            raise NotConstant()
+        return self.sized(self.functions[name](*args))
+
+
 if _ast:
     class FindIdentifiers(_ast_util.NodeVisitor):
 
@@ -196,6 +292,127 @@ if _ast:
                                                     p.undeclared_identifiers)
 
 
+    class FindCalls(_ast_util.NodeVisitor):
+
+        def __init__(self, listener, **exception_kwargs):
+            self.listener = listener
+            self.exception_kwargs = exception_kwargs
+
+        def visit_Call(self, node):
+            if isinstance(node.func, _ast.Name):
+                self.listener.names.add(node.func.id)
+            else:
+                self.listener.names.add(None)
+            self.generic_visit(node)
+
+
+    def string_type(expr):
+        """return the type of the string which the given parsed 
+        expression statement is known to produce: that of a literal 
+        string, or basestring for a call to capture(), else None."""
+ 
+        if len(expr.body) != 1 or not isinstance(expr.body[0], _ast.Expr):
+            return None
+        value = expr.body[0].value
+        if isinstance(value, _ast.Str):
+            return type(value.s)
+        elif isinstance(value, _ast.Call) and \
+                isinstance(value.func, _ast.Name) and \
+                value.func.id == 'capture':
+            return basestring
+        return None
+
+
+
+    class ConstantEvaluator(_ConstantOps):
+        """computes the value of a parsed expression statement made 
+        only of literals, operators, and calls to the given 
+        ``functions`` on them; raises NotConstant for any other 
+        expression, or one whose value or any part of it would be 
+        a sequence longer than ``limit``."""
+
+        op_symbols = {
+            'Add': '+', 'Sub': '-', 'Mult': '*', 'UAdd': '+',
+            'USub': '-', 'Invert': '~', 'Not': 'not', 'Eq': '==',
+            'NotEq': '!=', 'Lt': '<', 'LtE': '<=', 'Gt': '>',
+            'GtE': '>=', 'In': 'in', 'NotIn': 'not in', 'And': 'and',
+            'Or': 'or',
+        }
+
+        def symbol(self, op):
+            return self.op_symbols.get(op.__class__.__name__)
+
+        def visit(self, node):
+            method = getattr(self, 'visit_' + node.__class__.__name__, None)
+            if method is None:
+                raise NotConstant()
+            return method(node)
+
+        def visit_Module(self, node):
+            if len(node.body) != 1:
+                raise NotConstant()
+            return self.visit(node.body[0])
+
+        def visit_Expr(self, node):
+            return self.visit(node.value)
+
+        def visit_Str(self, node):
+            return node.s
+
+        def visit_Num(self, node):
+            return node.n
+
+        def visit_Name(self, node):
+            return self.name(node.id)
+
+        def visit_Tuple(self, node):
+            return tuple([self.visit(n) for n in node.elts])
+
+        def visit_List(self, node):
+            return [self.visit(n) for n in node.elts]
+
+        def visit_BinOp(self, node):
+            return self.binary(self.symbol(node.op), 
+                                self.visit(node.left), 
+                                self.visit(node.right))
+
+        def visit_UnaryOp(self, node):
+            return self.unary(self.symbol(node.op), self.visit(node.operand))
+
+        def visit_Compare(self, node):
+            return self.compare(self.visit(node.left), 
+                                [(self.symbol(op), self.visit(n)) 
+                                for op, n in zip(node.ops, node.comparators)])
+
+        def visit_BoolOp(self, node):
+            return self.boolean(self.symbol(node.op), 
+                                [self.visit(n) for n in node.values])
+
+        def visit_IfExp(self, node):
+            test, body, orelse = [self.visit(n) for n in 
+                                    (node.test, node.body, node.orelse)]
+            if test:
+                return body
+            return orelse
+
+        def visit_Call(self, node):
+            if not isinstance(node.func, _ast.Name) or node.keywords or \
+                    getattr(node, 'starargs', None) or \
+                    getattr(node, 'kwargs', None):
+                raise NotConstant()
+            return self.call(node.func.id, [self.visit(n) for n in node.args])
+
+        def visit_Subscript(self, node):
+            value = self.visit(node.value)
+            if isinstance(node.slice, _ast.Index):
+                return value[self.visit(node.slice.value)]
+            elif isinstance(node.slice, _ast.Slice):
+                return value[slice(*[self.optional(n) for n in 
+                                    (node.slice.lower, node.slice.upper, 
+                                    node.slice.step)])]
+            raise NotConstant()
+
+
     class ParseFunc(_ast_util.NodeVisitor):
 
         def __init__(self, listener, **exception_kwargs):
@@ -341,6 +558,141 @@ else:
             visitor.walk(expr, self)  # , walker=walker())
 
 
+    class FindCalls(object):
+
+        def __init__(self, listener, **exception_kwargs):
+            self.listener = listener
+            self.exception_kwargs = exception_kwargs
+
+        def visitCallFunc(self, node, *args):
+            if isinstance(node.node, compiler_ast.Name):
+                self.listener.names.add(node.node.name)
+            else:
+                self.listener.names.add(None)
+            for n in node.getChildNodes():
+                self.visit(n, *args)
+
+        def visit(self, expr):
+            visitor.walk(expr, self)
+
+
+    def string_type(expr):
+        """return the type of the string which the given parsed 
+        expression statement is known to produce: that of a literal 
+        string, or basestring for a call to capture(), else None."""
+ 
+        nodes = expr.node.nodes
+        if len(nodes) != 1 or not isinstance(nodes[0], compiler_ast.Discard):
+            return None
+        value = nodes[0].expr
+        if isinstance(value, compiler_ast.Const) and \
+                isinstance(value.value, basestring):
+            return type(value.value)
+        elif isinstance(value, compiler_ast.CallFunc) and \
+                isinstance(value.node, compiler_ast.Name) and \
+                value.node.name == 'capture':
+            return basestring
+        return None
+
+
+
+    class ConstantEvaluator(_ConstantOps):
+        """computes the value of a parsed expression statement made 
+        only of literals, operators, and calls to the given 
+        ``functions`` on them; raises NotConstant for any other 
+        expression, or one whose value or any part of it would be 
+        a sequence longer than ``limit``."""
+
+        def visit(self, node):
+            method = getattr(self, 'visit' + node.__class__.__name__, None)
+            if method is None:
+                raise NotConstant()
+            return method(node)
+
+        def visitModule(self, node):
+            # a string by itself is parsed as the docstring
+            if node.doc is not None and not node.node.nodes:
+                return node.doc
+            return self.visit(node.node)
+
+        def visitStmt(self, node):
+            if len(node.nodes) != 1:
+                raise NotConstant()
+            return self.visit(node.nodes[0])
+
+        def visitDiscard(self, node):
+            return self.visit(node.expr)
+
+        def visitConst(self, node):
+            return node.value
+
+        def visitName(self, node):
+            return self.name(node.name)
+
+        def visitTuple(self, node):
+            return tuple([self.visit(n) for n in node.nodes])
+
+        def visitList(self, node):
+            return [self.visit(n) for n in node.nodes]
+
+        def visitAdd(self, node):
+            return self.binary('+', self.visit(node.left), 
+                                self.visit(node.right))
+
+        def visitSub(self, node):
+            return self.binary('-', self.visit(node.left), 
+                                self.visit(node.right))
+
+        def visitMul(self, node):
+            return self.binary('*', self.visit(node.left), 
+                                self.visit(node.right))
+
+        def visitUnaryAdd(self, node):
+            return self.unary('+', self.visit(node.expr))
+
+        def visitUnarySub(self, node):
+            return self.unary('-', self.visit(node.expr))
+
+        def visitInvert(self, node):
+            return self.unary('~', self.visit(node.expr))
+
+        def visitNot(self, node):
+            return self.unary('not', self.visit(node.expr))
+
+        def visitCompare(self, node):
+            return self.compare(self.visit(node.expr), 
+                                [(op, self.visit(n)) for op, n in node.ops])
+
+        def visitAnd(self, node):
+            return self.boolean('and', [self.visit(n) for n in node.nodes])
+
+        def visitOr(self, node):
+            return self.boolean('or', [self.visit(n) for n in node.nodes])
+
+        def visitIfExp(self, node):
+            test, then, else_ = [self.visit(n) for n in 
+                                    (node.test, node.then, node.else_)]
+            if test:
+                return then
+            return else_
+
+        def visitCallFunc(self, node):
+            if not isinstance(node.node, compiler_ast.Name) or \
+                    node.star_args or node.dstar_args:
+                raise NotConstant()
+            # keyword arguments are Keyword nodes, which aren't constant
+            return self.call(node.node.name, [self.visit(n) for n in node.args])
+
+        def visitSubscript(self, node):
+            if len(node.subs) != 1:
+                raise NotConstant()
+            return self.visit(node.expr)[self.visit(node.subs[0])]
+
+        def visitSlice(self, node):
+            return self.visit(node.expr)[self.optional(node.lower):
+                                            self.optional(node.upper)]
+
+
     class ParseFunc(object):
 
         def __init__(self, listener, **exception_kwargs):
@@ -7,7 +7,8 @@
 """Provides the Template class, a facade for parsing, generating and executing
 template strings, as well as template runtime operations."""
 
-from mako.lexer import Lexer
+from mako.lexer import Lexer, preprocessor_fingerprint
+from mako import __version__
 from mako import runtime, util, exceptions, codegen, cache
 import imp, os, re, shutil, stat, sys, tempfile, time, types, weakref
 
@@ -94,6 +95,15 @@ class Template(object):
      preamble of all generated Python modules. See the example
      in :ref:`filtering_default_filters`.
 
+    :param incremental_lexing: if ``True``, the parser of a
+     template loaded from a file is retained in memory, keyed on the
+     filename.  When the file changes, such as when a 
+     :class:`.TemplateLookup` with ``filesystem_checks`` reloads it 
+     during development, parse tree nodes at the start and end of 
+     the template which are outside of the edited region are copied 
+     from the previous parse, and only the edited region is lexed 
+     again.  New in 0.5.1.
+
     :param input_encoding: Encoding of the template's source code.  Can
      be used in lieu of the coding comment. See
      :ref:`usage_unicode` as well as :ref:`unicode_toplevel` for
@@ -114,16 +124,47 @@ class Template(object):
      is called.  
      See :ref:`usage_unicode` as well as :ref:`unicode_toplevel`.
  
+    :param parsetree_cache: if ``True``, the parse tree of the template
+     is cached, keyed on a hash of the template source along with the
+     preprocessor and lexer options, so that regenerating the Python
+     module for unchanged source, such as after a Mako upgrade or
+     a change in ``default_filters``, skips lexing entirely.  Parse
+     trees are held in memory for the life of the process, and when
+     ``module_directory`` is used are also stored alongside the
+     generated module file.  Templates using a preprocessor which
+     neither declares a ``fingerprint`` nor is a plain module-level 
+     function are never cached.  New in 0.5.1.
+
     :param preprocessor: Python callable which will be passed 
      the full template source before it is parsed. The return
      result of the callable will be used as the template source
-     code.
+     code.  A list of callables may also be passed, which are
+     applied in turn.  The output of preprocessors which declare 
+     a ``fingerprint`` attribute, or which are plain module-level
+     functions, is cached; see :func:`.preprocessor_fingerprint`
+     and :mod:`mako.ext.preprocessors`.
  
     :param strict_undefined: Replaces the automatic usage of 
      ``UNDEFINED`` for any undeclared variables not located in
      the :class:`.Context` with an immediate raise of
      ``NameError``. The advantage is immediate reporting of
      missing variables which include the name. New in 0.3.6.
+
+    :param bind_builtins: When ``True``, names of Python builtins
+     which a template refers to without assigning them, such
+     as ``len`` or ``enumerate``, are the builtins themselves,
+     rather than first being looked up in the :class:`.Context`.
+     A value passed to :meth:`~.Template.render` under such a
+     name is then ignored by the template.  Defaults to
+     ``False``.
+
+    :param lazy_declares: When ``True``, a variable which a
+     render function refers to only within a branch of a
+     ``% if`` is looked up in the :class:`.Context` when that
+     branch is taken, rather than when the function is called.
+     With ``strict_undefined``, a missing variable is then
+     reported only if its branch is taken.  Defaults to
+     ``False``.
  
     :param uri: string uri or other identifier for this template. 
      If not provided, the uri is generated from the filesystem
@@ -158,8 +199,12 @@ class Template(object):
                     default_filters=None, 
                     buffer_filters=(), 
                     strict_undefined=False,
+                    bind_builtins=False,
+                    lazy_declares=False,
                     imports=None, 
-                    preprocessor=None):
+                    preprocessor=None,
+                    parsetree_cache=False,
+                    incremental_lexing=False):
         if uri:
             self.module_id = re.sub(r'\W', "_", uri)
             self.uri = uri
@@ -188,6 +233,8 @@ class Template(object):
         self.disable_unicode = disable_unicode
         self.bytestring_passthrough = bytestring_passthrough or disable_unicode
         self.strict_undefined = strict_undefined
+        self.bind_builtins = bind_builtins
+        self.lazy_declares = lazy_declares
 
         if util.py3k and disable_unicode:
             raise exceptions.UnsupportedError(
@@ -208,6 +255,8 @@ class Template(object):
  
         self.imports = imports
         self.preprocessor = preprocessor
+        self.parsetree_cache = parsetree_cache
+        self.incremental_lexing = incremental_lexing
  
         # if plain text, compile code in memory only
         if text is not None:
@@ -274,7 +323,7 @@ class Template(object):
                         os.stat(path)[stat.ST_MTIME] < filemtime:
                 _compile_module_file(
                             self, 
-                            open(filename, 'rb').read(), 
+                            util.map_file(open(filename, 'rb')), 
                             filename, 
                             path)
             module = imp.load_source(self.module_id, path, open(path, 'rb'))
@@ -282,7 +331,7 @@ class Template(object):
             if module._magic_number != codegen.MAGIC_NUMBER:
                 _compile_module_file(
                             self, 
-                            open(filename, 'rb').read(), 
+                            util.map_file(open(filename, 'rb')), 
                             filename, 
                             path)
                 module = imp.load_source(self.module_id, path, open(path, 'rb'))
@@ -293,7 +342,7 @@ class Template(object):
             # in memory
             code, module = _compile_text(
                                 self, 
-                                open(filename, 'rb').read(), 
+                                util.map_file(open(filename, 'rb')), 
                                 filename)
             self._source = None
             self._code = code
@@ -515,14 +564,98 @@ class ModuleInfo(object):
             else:
                 return open(self.template_filename).read()
  
-def _compile_text(template, text, filename):
-    identifier = template.module_id
+# parse trees cached in memory when parsetree_cache is enabled,
+# keyed on _parsetree_key().
+_parsetrees = util.LRUCache(100)
+
+# the Lexer which last parsed each template file, when 
+# incremental_lexing is enabled.
+_lexers = util.LRUCache(100)
+
+def _parsetree_key(template, text, filename):
+    """return a key identifying the parse tree of the given template
+    source, or None if the tree can't be cached.
+ 
+    the key consists of a hash of the source along with everything
+    else that the Lexer is given.  preprocessors are identified by
+    preprocessor_fingerprint(), so are only allowed if they 
+    declare a fingerprint or are plain functions whose behavior 
+    can't vary between instances.
+ 
+    """
+    preprocessor = template.preprocessor
+    if preprocessor is None:
+        preprocessor = []
+    elif not hasattr(preprocessor, '__iter__'):
+        preprocessor = [preprocessor]
+    fingerprint = preprocessor_fingerprint(preprocessor)
+    if fingerprint is None:
+        return None
+
+    return (util.text_digest(text), fingerprint, filename, 
+                template.disable_unicode, template.input_encoding, 
+                __version__)
+
+def _parse(template, text, filename, outputpath=None):
+    """lex the given template source, returning the source encoding
+    and the root TemplateNode.
+ 
+    when the template's parsetree_cache is enabled, trees are
+    retrieved from memory, or from a file stored next to the
+    given module outputpath, before lexing.  when its 
+    incremental_lexing is enabled, the previous Lexer of the 
+    same file is passed to Lexer.parse().
+ 
+    """
+    key = None
+    if template.parsetree_cache:
+        key = _parsetree_key(template, text, filename)
+    if key is not None:
+        if key in _parsetrees:
+            return _parsetrees[key]
+        if outputpath is not None:
+            treepath = outputpath + ".tree"
+            if os.path.exists(treepath):
+                try:
+                    stored_key, parsed = util.pickle.load(
+                                                open(treepath, 'rb'))
+                except Exception:
+                    # unreadable or from an incompatible version;
+                    # regenerate.
+                    stored_key = None
+                if stored_key == key:
+                    _parsetrees[key] = parsed
+                    return parsed
+
     lexer = Lexer(text, 
                     filename, 
                     disable_unicode=template.disable_unicode,
                     input_encoding=template.input_encoding,
                     preprocessor=template.preprocessor)
-    node = lexer.parse()
+    previous = None
+    incremental = template.incremental_lexing and filename is not None
+    if incremental:
+        try:
+            previous = _lexers[filename]
+        except KeyError:
+            pass
+    node = lexer.parse(previous=previous)
+    if incremental:
+        _lexers[filename] = lexer
+    parsed = (lexer.encoding, node)
+
+    if key is not None:
+        _parsetrees[key] = parsed
+        if outputpath is not None:
+            (dest, name) = tempfile.mkstemp(dir=os.path.dirname(outputpath))
+            os.write(dest, util.pickle.dumps((key, parsed), 2))
+            os.close(dest)
+            shutil.move(name, treepath)
+    return parsed
+
+def _compile_text(template, text, filename):
+    identifier = template.module_id
+    encoding, node = _parse(template, text, filename)
  
     source = codegen.compile(node, 
                             template.uri, 
@@ -530,10 +663,12 @@ def _compile_text(template, text, filename):
                             default_filters=template.default_filters,
                             buffer_filters=template.buffer_filters, 
                             imports=template.imports, 
-                            source_encoding=lexer.encoding,
+                            source_encoding=encoding,
                             generate_magic_comment=template.disable_unicode,
                             disable_unicode=template.disable_unicode,
-                            strict_undefined=template.strict_undefined)
+                            strict_undefined=template.strict_undefined,
+                            bind_builtins=template.bind_builtins,
+                            lazy_declares=template.lazy_declares)
 
     cid = identifier
     if not util.py3k and isinstance(cid, unicode):
@@ -545,23 +680,19 @@ def _compile_text(template, text, filename):
 
 def _compile_module_file(template, text, filename, outputpath):
     identifier = template.module_id
-    lexer = Lexer(text, 
-                    filename, 
-                    disable_unicode=template.disable_unicode,
-                    input_encoding=template.input_encoding,
-                    preprocessor=template.preprocessor)
- 
-    node = lexer.parse()
+    encoding, node = _parse(template, text, filename, outputpath)
     source = codegen.compile(node, 
                                 template.uri, 
                                 filename,
                                 default_filters=template.default_filters,
                                 buffer_filters=template.buffer_filters,
                                 imports=template.imports,
-                                source_encoding=lexer.encoding,
+                                source_encoding=encoding,
                                 generate_magic_comment=True,
                                 disable_unicode=template.disable_unicode,
-                                strict_undefined=template.strict_undefined)
+                                strict_undefined=template.strict_undefined,
+                                bind_builtins=template.bind_builtins,
+                                lazy_declares=template.lazy_declares)
  
     # make tempfiles in the same location as the ultimate 
     # location.   this ensures they're on the same filesystem,
@@ -569,7 +700,7 @@ def _compile_module_file(template, text, filename, outputpath):
     (dest, name) = tempfile.mkstemp(dir=os.path.dirname(outputpath))
  
     if isinstance(source, unicode):
-        source = source.encode(lexer.encoding or 'ascii')
+        source = source.encode(encoding or 'ascii')
  
     os.write(dest, source)
     os.close(dest)
@@ -23,6 +23,21 @@ else:
 import codecs, re, weakref, os, time, operator
 import collections
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
 try:
     import threading
     import thread
@@ -106,6 +121,37 @@ def verify_directory(dir):
             if tries > 5:
                 raise
 
+def text_digest(text):
+    """return the hex sha1 digest of the given string, unicode 
+    string or buffer, unicode being hashed as utf-8."""
+ 
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return sha1(text).hexdigest()
+
+def map_file(fp):
+    """return the full contents of the given file object as a 
+    read-only memory map, or as a string if the file can't be 
+    mapped, such as when it's empty or not on the filesystem."""
+ 
+    if mmap is not None:
+        try:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            pass
+    return fp.read()
+
+def is_mapped(obj):
+    """return True if the given object is a memory map."""
+ 
+    return mmap is not None and isinstance(obj, mmap.mmap)
+
+if py3k:
+    def buffer_view(obj, offset=0):
+        return memoryview(obj)[offset:]
+else:
+    buffer_view = buffer
+
 def to_list(x, default=None):
     if x is None:
         return default
@@ -232,6 +232,138 @@ import x as bar
         assert parsed.funcname=='foo'
         assert parsed.argnames==['a', 'b', 'c', 'args', 'kwargs']
  
+    def test_simple_names(self):
+        for code, undeclared in [
+            ("x", ['x']),
+            ("  user . name\n", ['user']),
+            ("None", []),
+            ("x.None", ['x']),
+        ]:
+            parsed = ast.PythonCode(code, **exception_kwargs)
+            eq_(parsed.declared_identifiers, set())
+            eq_(parsed.undeclared_identifiers, set(undeclared))
+
+        parsed = ast.ArgumentList("h, trim", **exception_kwargs)
+        eq_(parsed.args, ['h', 'trim'])
+        eq_(parsed.undeclared_identifiers, set(['h', 'trim']))
+
+        for code in ["lambda", "x.if", "x\n.y"]:
+            self.assertRaises(exceptions.SyntaxException, 
+                        ast.PythonCode, code, **exception_kwargs)
+        for code in ["h,", " h", "h\n", "h, print"]:
+            self.assertRaises(exceptions.SyntaxException, 
+                        ast.ArgumentList, code, **exception_kwargs)
+
+    def test_analysis_memo(self):
+        ast.analysis_memo.clear()
+        for i in range(3):
+            parsed = ast.PythonCode("x = y + 5", **exception_kwargs)
+            eq_(parsed.declared_identifiers, set(['x']))
+            eq_(parsed.undeclared_identifiers, set(['y']))
+            parsed.undeclared_identifiers.add('q')
+
+            parsed = ast.ArgumentList("a, b.c", **exception_kwargs)
+            eq_(parsed.args, ["a", "b.c"])
+            eq_(parsed.undeclared_identifiers, set(['a', 'b']))
+            eq_(parsed.codeargs[1].undeclared_identifiers, set(['b']))
+            parsed.args.append('d')
+            parsed.codeargs[1].undeclared_identifiers.add('q')
+
+            parsed = ast.FunctionDecl("def foo(a, b=5):pass", 
+                                        **exception_kwargs)
+            eq_(parsed.argnames, ['a', 'b'])
+            eq_(parsed.get_argument_expressions(), ['a', 'b=5'])
+            parsed.argnames.append('c')
+        eq_(ast.analysis_memo.misses, 3)
+        eq_(ast.analysis_memo.hits, 6)
+
+    def test_analysis_memo_types(self):
+        for code in [u"foo(a, 'b')", "foo(a, 'b')", u"foo(a, 'b')"]:
+            parsed = ast.CallArguments(code, **exception_kwargs)
+            eq_(parsed.args, ["a", "'b'"])
+            for arg in parsed.args:
+                assert type(arg) is type(code)
+
+    def test_analysis_memo_errors(self):
+        code = "def foo(**kw):pass"
+        ast.FunctionDecl(code, **exception_kwargs)
+        self.assertRaises(exceptions.CompileException, 
+                    ast.FunctionDecl, code, allow_kwargs=False,
+                    **exception_kwargs)
+
+        code = "x = \\"
+        for i in range(2):
+            self.assertRaises(exceptions.SyntaxException, 
+                        ast.PythonCode, code, **exception_kwargs)
+
+    def test_called_names(self):
+        for code, names in [
+            ("x.y + 5", []),
+            ("'(' + x", []),
+            ("len(x) and max(x, key=f) or ''", ['len', 'max']),
+            ("foo(bar(x))", ['foo', 'bar']),
+            ("self.foo() or x", [None]),
+            ("[f(y) for y in x][0]()", [None, 'f']),
+        ]:
+            parsed = ast.CalledNames(code, **exception_kwargs)
+            eq_(parsed.names, set(names))
+
+    def test_string_type(self):
+        for code, type_ in [
+            ("'abc'", str),
+            ("u'abc' 'def'", unicode),
+            ("capture(foo, x)", basestring),
+            ("'a' + x", None),
+            ("x", None),
+            ("capture", None),
+        ]:
+            eq_(ast.StringType(code, **exception_kwargs).type, type_)
+        eq_(ast.StringType("u'abc'", **exception_kwargs).value, u'abc')
+
+    def test_constant_value(self):
+        for code, value in [
+            ("'&nbsp;' * 4", '&nbsp;&nbsp;&nbsp;&nbsp;'),
+            ("len('abc')", 3),
+            ("u'<b>'", u'<b>'),
+            ("-1 + 2 * 3", 5),
+            ("'abc'[1:] if 1 < 2 else None", 'bc'),
+            ("str(min(3, 4)) + 'px'", '3px'),
+            ("0 or 'x' and None", None),
+        ]:
+            const = ast.ConstantValue(code, **exception_kwargs)
+            assert const.is_constant, code
+            eq_(const.value, value)
+
+        for code in [
+            "x",
+            "'abc'.upper()",
+            "foo('abc')",
+            "1 / 2",
+            "'%s' % 5",
+            "'x' * 100000",
+            "len(5)",
+            "(1, 2)",
+        ]:
+            assert not ast.ConstantValue(code, **exception_kwargs).is_constant, \
+                        code
+
+    def test_call_arguments(self):
+        call = ast.CallArguments("foo(a, b[1], c=bar(1, 2), d={1:2})", 
+                                    **exception_kwargs)
+        eq_(call.name, "foo")
+        eq_(call.args, ["a", "b[1]"])
+        eq_(call.kwargs, [("c", "bar(1, 2)"), ("d", "{1:2}")])
+        for code in ["foo", "x.foo(a)", "foo(*a)", "foo(**a)", 
+                        "foo(a)(b)", "foo(a) + bar(b)"]:
+            eq_(ast.CallArguments(code, **exception_kwargs).name, None)
+
+    def test_rename(self):
+        eq_(
+            ast.rename("for x in f(x, x=x.x): # x", {'x':'y'}), 
+            "for y in f(y, x=y.x): # x"
+        )
+        eq_(ast.rename("{x: 'x'}[x == 1]", {'x':'y'}), "{y: 'x'}[y == 1]")
+
     def test_expr_generate(self):
         """test the round trip of expressions to AST back to python source"""
         x = 1
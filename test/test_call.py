@@ -1,5 +1,7 @@
 from mako.template import Template
-from mako import util
+from mako.lexer import Lexer
+from mako import util, codegen
+import inspect, sys
 from util import result_lines, flatten_result
 from test import TemplateTest, eq_
 
@@ -470,6 +472,54 @@ class CallTest(TemplateTest):
 """)
         assert result_lines(t.render()) == ['this is a', 'this is b', 'this is c:', "this is the body in b's call", 'the embedded "d" is:', 'this is d']
 
+    def test_deeply_nested(self):
+        # nested tags are traversed without recursion; the generated
+        # module is too deeply indented for Python to compile, but
+        # generating it must not hit the recursion limit.
+        depth = 300
+        template = '<%call expr="foo()">${x}' * depth + '</%call>' * depth
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(inspect.stack()) + 100)
+        try:
+            code = codegen.compile(Lexer(template).parse(), 'deep', 
+                                    default_filters=['unicode'])
+        finally:
+            sys.setrecursionlimit(limit)
+        eq_(code.count("def ccall(caller):"), depth)
+
+    def test_frameless_defs(self):
+        """test that defs which can't observe the caller stack are
+        written without a frame on it, and that the others still
+        see the caller of their own <%call>"""
+
+        t = Template("""
+        <%def name="cell(x)">
+            <%def name="square()">[${x}]</%def>
+            cell ${square()}
+        </%def>
+        <%def name="row(x)" buffered="True">row ${cell(x)}</%def>
+        <%def name="plain()">plain ${row(1)}</%def>
+        <%def name="wrap()">wrap ${caller.body()} ${outer()}</%def>
+        <%def name="outer()">outer ${bool(caller)} ${inner()}</%def>
+        <%def name="inner()">inner ${bool(caller)}</%def>
+        <%call expr="plain()">not written</%call>
+        <%call expr="wrap()">body ${row(2)}</%call>
+""")
+        for name in ('cell', 'row'):
+            code = t.code[t.code.index("def render_%s(" % name):]
+            code = code[:code.index("\n\n")]
+            assert "_push_frame" not in code
+        for name in ('plain', 'wrap', 'outer', 'inner'):
+            code = t.code[t.code.index("def render_%s(" % name):]
+            assert code.index("_push_frame") < code.index("\n\n")
+        eq_(result_lines(t.render()), [
+            "plain row",
+            "cell [1]",
+            "wrap body row",
+            "cell [2]",
+            "outer False inner False"
+        ])
+
 class SelfCacheTest(TemplateTest):
     """this test uses a now non-public API."""
  
@@ -1,6 +1,6 @@
 from mako.template import Template
 from mako import lookup
-from test import TemplateTest
+from test import TemplateTest, eq_
 from util import flatten_result, result_lines
 
 class DefTest(TemplateTest):
@@ -345,6 +345,51 @@ class ScopeTest(TemplateTest):
         except UnboundLocalError:
             assert True
 
+    def test_enclosing_locals(self):
+        """test that the variables of the body's python blocks are
+        passed to just the top-level defs which read them, as they
+        are after the block assigning them"""
+
+        t = Template("""
+            <%def name="a(y)">a ${y} ${b()}</%def>
+            <%def name="b()">b ${y} ${z}</%def>
+            <%def name="c(q)">c ${q}</%def>
+            % if flag:
+            <% y = 'local y' %>
+            % endif
+            % for z in range(2):
+            <% z = z * 10 %>
+            ${a('arg')} ${c(z)}
+            % endfor
+""")
+        assert "return render_c(context,q)" in t.code
+        assert result_lines(t.render(flag=True, y='context y')) == [
+            "a arg b local y 0 c 0",
+            "a arg b local y 10 c 10"
+        ]
+        assert result_lines(t.render(flag=False, y='context y')) == [
+            "a arg b context y 0 c 0",
+            "a arg b context y 10 c 10"
+        ]
+
+    def test_enclosing_locals_assigned(self):
+        """test that the variables passed to defs are those assigned 
+        by python blocks, including those of <%call> bodies, and not
+        by control lines or deleted later"""
+
+        t = Template("""
+            <%def name="foo()">${x}</%def>
+            <%def name="bar()">${y}</%def>
+            <%def name="wrap()">${caller.body()}</%def>
+            <% x = 5 %>
+            % for x in [1, 2]:
+            ${foo()}
+            % endfor
+            <% del x %>
+            <%call expr="wrap()"><% y = 7 %>${bar()}</%call>
+""")
+        assert result_lines(t.render()) == ["5", "5", "7"]
+
     def test_canget_kwargs(self):
         """test that arguments passed to the body() function are accessible by top-level defs"""
         l = lookup.TemplateLookup()
@@ -548,3 +593,82 @@ class ExceptionTest(TemplateTest):
     """, error_handler=handle)
         assert template.render().strip() == """error message is this is a test"""
  
+
+class InlineDefTest(TemplateTest):
+    def test_inlined(self):
+        t = Template("""
+<%def name="cell(value, cls='c')"><td class="${cls}">${value | h}</td></%def>
+<%def name="items(xs)">
+% for x in xs:
+<li>${x}</li>
+% endfor
+</%def>
+% for x in rows:
+${cell(x)}${cell(len(x), cls='n')}
+% endfor
+${items(rows)} ${x}
+""")
+        # the defs are written in place of their calls, with 
+        # their own names renamed apart from the caller's
+        assert "cell(x)" not in t.code
+        assert "__M_cell_value = x" in t.code
+        assert "__M_cell_cls = 'n'" in t.code
+        assert "for __M_items_x in __M_items_xs:" in t.code
+        eq_(
+            result_lines(t.render_unicode(rows=['a<', 'b'], x='x')),
+            [
+                '<td class="c">a&lt;</td><td class="n">2</td>',
+                '<td class="c">b</td><td class="n">1</td>',
+                '<li>a<</li>',
+                '<li>b</li>',
+                'b'
+            ]
+        )
+
+    def test_not_inlined(self):
+        t = Template("""
+<%def name="ctx(x)">${x}${y}</%def>
+<%def name="rec(n)">${n}${rec(n - 1) if n else ''}</%def>
+<%def name="opt(x)" inline="False">${x}</%def>
+<%def name="star(*args)">${args}</%def>
+<%def name="dflt(x=[])">${x}</%def>
+${ctx(1)} ${rec(2)} ${opt(3)} ${star(4)} ${dflt()} ${self.opt(5)}
+""")
+        # the context, calls of defs, and opting out prevent inlining,
+        # as does a default which isn't a constant
+        for call in ["ctx(1)", "rec(2)", "opt(3)", "star(4)", "dflt()"]:
+            assert "__M_value = (%s)" % call in t.code, call
+        eq_(
+            flatten_result(t.render_unicode(y='y')),
+            "1y 210 3 (4,) [] 5"
+        )
+
+    def test_shadowed(self):
+        t = Template("""
+<%def name="cell(x)">${x}</%def>
+<%def name="foo()"><% cell = len %>${cell('abc')}</%def>
+${foo()} ${cell(1)}
+""")
+        assert "__M_value = (cell('abc'))" in t.code
+        eq_(flatten_result(t.render_unicode()), "3 1")
+
+    def test_filters_shadowed(self):
+        # the filters of a call which the template binds itself are 
+        # applied to the def's return value at runtime
+        t = Template("""<%def name="g(x)">${x}</%def>"""
+                    """<% str = lambda x: 'S' %>${g(1) | str}""")
+        eq_(t.render_unicode(), "1S")
+        t = Template("""<%! unicode = lambda x: u'U' %>"""
+                    """<%def name="f()">a ${'b' | h}</%def>${f()}""")
+        eq_(t.render_unicode(), "a UU")
+
+    def test_builtins(self):
+        text = """<%def name="size(x)">${len(x)}</%def>${size('ab')}"""
+        # a def referring to a builtin looks it up in the context, 
+        # so it's inlined only when builtins are bound
+        t = Template(text)
+        assert "__M_value = (size('ab'))" in t.code
+        eq_(t.render_unicode(len=lambda x:42), "42")
+        t = Template(text, bind_builtins=True)
+        assert "size('ab')" not in t.code
+        eq_(t.render_unicode(), "2")
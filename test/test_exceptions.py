@@ -187,3 +187,45 @@ ${foobar}
                     render_unicode(error=v, traceback=None)
  
         assert "local variable 'y' referenced" in html_error
+
+    def test_tback_multiline_expression(self):
+        t = Template("""<%def name="foo(a, b, c)" inline="False">${a}</%def>
+${foo(1,
+    2,
+    3)} ${max(1,
+    2)}
+% if x:
+${x / 0}
+${x}
+% endif
+""")
+        try:
+            t.render(x=1)
+        except:
+            tback = exceptions.RichTraceback()
+        assert tback.lineno == 7
+        assert tback.traceback[-1][1:] == (7, 'render_body', '${x / 0}')
+
+    def test_tback_before_source(self):
+        # the inheritance callable is written ahead of any code of
+        # the template's lines
+        t = Template("""<% x = 1 %>
+<%inherit file="${1/0}"/>
+""")
+        try:
+            t.render()
+        except:
+            tback = exceptions.RichTraceback()
+        assert tback.lineno == 1
+
+    def test_tback_no_source_map(self):
+        # a module compiled by an earlier version has no _source_map
+        t = Template("""hello
+${1/0}
+""")
+        del t.module._source_map
+        try:
+            t.render()
+        except:
+            tback = exceptions.RichTraceback()
+        assert tback.traceback[-1][2] == 'render_body'
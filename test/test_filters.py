@@ -208,6 +208,67 @@ class FilterTest(TemplateTest):
 """)
         assert flatten_result(t.render()) == "http://foo.com/arg1=hi%21+this+is+a+string."
 
+    def test_escapes(self):
+        from mako import filters
+        for escape in (filters.xml_escape, filters.legacy_html_escape):
+            eq_(escape(u"<a href='x'>&amp;\"</a>"), 
+                u"&lt;a href=&#39;x&#39;&gt;&amp;amp;&#34;&lt;/a&gt;")
+            eq_(escape("a & b"), "a &amp; b")
+            assert type(escape(u"x")) is unicode
+
+    def test_bound_filters(self):
+        t = Template("""
+            <%def name="foo(x)">${x | h}</%def>
+            ${x | unicode} ${x | entity} ${x | trim, trim} ${foo(x)}
+""")
+        assert "__M_unicode = unicode" in t.code
+        assert "__M_html_escape = filters.html_escape" in t.code
+
+        # redundant filters are dropped from the chains
+        assert "__M_unicode(__M_unicode(" not in t.code
+        assert "__M_html_entities_escape(x )" in t.code
+        assert "__M_trim(__M_unicode(x ))" in t.code
+        eq_(
+            flatten_result(t.render_unicode(x=u" <\u00e9> ")),
+            u"<\u00e9> &lt;&eacute;&gt; <\u00e9> &lt;\u00e9&gt;"
+        )
+
+    def test_coercion_elided(self):
+        # written as static text
+        t = Template("""${'abc'}""")
+        assert "__M_writer(u'abc')" in t.code
+
+        t = Template("""<%def name="foo()">foo</%def>${capture(foo)}""")
+        assert "__M_writer(capture(foo))" in t.code
+        eq_(t.render_unicode(), u"foo")
+
+        # formatted with the text around it, coerced as it's 
+        # evaluated
+        t = Template("""<b>${x}</b>""")
+        assert "__M_unicode(x),\n" in t.code
+        eq_(t.render_unicode(x=5), u"<b>5</b>")
+
+        # checked at runtime
+        t = Template("""${x.strip()}""")
+        assert "__M_value = (x.strip())" in t.code
+        assert "if __M_type(__M_value) is not __M_unicode:" in t.code
+        eq_(t.render_unicode(x=u" \u00e9 "), u"\u00e9")
+        eq_(t.render_unicode(x="x"), u"x")
+
+        t = Template("""${u'abc'.upper()}<b>${x}</b>""", disable_unicode=True)
+        assert "__M_str(__M_value)" in t.code
+        assert "str(x)" in t.code
+        eq_(t.render(x=5), "ABC<b>5</b>")
+
+        # unless the template binds the name of the coercion itself
+        t = Template("""<%def name="foo()">foo</%def>"""
+                    """<% unicode = lambda x: u'U' %>"""
+                    """${'a'} ${capture(foo)} <b>${1}</b>""")
+        eq_(t.render_unicode(), u"U U <b>U</b>")
+        t = Template("""<%! str = lambda x: 'S' %>${'a'}""", 
+                        disable_unicode=True)
+        eq_(t.render(), "S")
+
 class BufferTest(unittest.TestCase): 
     def test_buffered_def(self):
         t = Template("""
@@ -4,7 +4,7 @@ from mako.lexer import Lexer
 from mako import exceptions, util
 from util import flatten_result, result_lines
 from mako.template import Template
-import re
+import os, re, time
 from test import TemplateTest, template_base, skip_if, eq_, assert_raises_message
 
 # create fake parsetree classes which are constructed
@@ -34,6 +34,14 @@ class %s(object):
             )
 """ % clsname) in locals()
 
+def _no_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        return True
+    else:
+        return False
+
 # NOTE: most assertion expressions were generated, then formatted
 # by PyTidy, hence the dense formatting.
 
@@ -144,6 +152,180 @@ class LexerTest(TemplateTest):
                       ControlLine(u'if', u'endif', True, (7, 1)),
                       Text(u'        ', (8, 1))]))
 
+    def test_text_with_construct_characters(self):
+        template = """costs $5 <b>#1</b> \\\\ or \\
+more ${x}
+"""
+        nodes = Lexer(template).parse()
+        self._compare(nodes, TemplateNode({},
+                      [Text(u'costs $5 <b>#1</b> \\\\ or ', (1, 1)),
+                      Text(u'more ', (2, 1)), Expression(u'x', [], (2, 6)),
+                      Text(u'\n', (2, 10))]))
+
+    def test_unclosed_doc(self):
+        assert_raises_message(
+            exceptions.CompileException,
+            "No such tag: 'doc' at line: 1 char: 4",
+            Lexer("hi <%doc> there").parse
+        )
+
+    def test_position_tracking_is_linear(self):
+        # long lines containing many constructs; the line and
+        # character position of each match must not be located 
+        # by rescanning the text.
+        def lex_time(size):
+            line = ("x" * 1000 + "<&") * 250 + "\n"
+            text = line * (size // len(line))
+            best = None
+            for i in range(3):
+                now = time.time()
+                Lexer(text).parse()
+                elapsed = time.time() - now
+                if best is None or elapsed < best:
+                    best = elapsed
+            return best
+
+        size = 5 * 1024 * 1024
+        small, large = lex_time(size // 4), lex_time(size)
+        # linear growth gives a ratio of about 4, quadratic about 16
+        assert large < small * 10, \
+                    "%.3f sec for 5MB vs. %.3f sec for 1.25MB" % (large, small)
+
+    def test_nodes_share_source_file(self):
+        template = """
+        <%def name="foo()">
+            ${x | h}
+        </%def>
+        % if y:
+            <%include file="bar.html"/>
+        % endif
+"""
+        node = Lexer(template, 'foo.html').parse()
+        source_file = node.nodes[0].source_file
+        def walk(n):
+            assert not hasattr(n, '__dict__'), n
+            for c in n.get_children():
+                assert c.source_file is source_file
+                walk(c)
+        walk(node)
+        eq_(node.nodes[1].filename, 'foo.html')
+        eq_(node.nodes[1].source, template)
+
+    @skip_if(_no_tracemalloc, "tracemalloc not available")
+    def test_node_memory(self):
+        import tracemalloc
+
+        class DictText(parsetree.Text):
+            """a Text node with a __dict__, as nodes were formerly"""
+
+        source_file = parsetree.SourceFile("some text", "foo.html")
+        def measure(cls):
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                nodes = [cls("some text", source_file=source_file, 
+                                lineno=1, pos=i) for i in range(1000)]
+                return tracemalloc.get_traced_memory()[0] - before
+            finally:
+                tracemalloc.stop()
+        slotted, with_dict = measure(parsetree.Text), measure(DictText)
+        assert slotted < with_dict, \
+                    "%d bytes per node vs. %d bytes per node with __dict__" % (
+                    slotted // 1000, with_dict // 1000)
+
+    def test_text_spans(self):
+        template = """hello <%text>${x}</%text> world"""
+        node = Lexer(template, 'foo.html').parse()
+        texts = [node.nodes[0], node.nodes[1].nodes[0], node.nodes[2]]
+        eq_([t.content for t in texts], ["hello ", "${x}", " world"])
+        for t in texts:
+            assert t._content is None
+            eq_(t.content, template[t.start:t.end])
+
+    def test_file_source(self):
+        from StringIO import StringIO
+        for name in ('bom.html', 'bommagic.html', 'chs_utf8.html'):
+            path = os.path.join(template_base, name)
+            expected = Lexer(open(path, 'rb').read(), path).parse()
+            for source in (
+                    open(path, 'rb'), 
+                    util.map_file(open(path, 'rb')), 
+                    StringIO(open(path, 'rb').read())):
+                lexer = Lexer(source, path)
+                eq_(repr(lexer.parse()), repr(expected))
+                assert isinstance(lexer.text, unicode)
+
+        path = os.path.join(template_base, 'badbom.html')
+        assert_raises_message(
+            exceptions.CompileException,
+            "Found utf-8 BOM in file, with conflicting magic "
+            "encoding comment of 'ascii'",
+            Lexer(open(path, 'rb'), path).parse
+        )
+
+    def test_incremental(self):
+        template = """<%def name="a()">
+    % for x in y:
+        <%call expr="b()">${x}</%call>
+    % endfor
+</%def>
+## a comment
+<%def name="b()">b</%def>
+${a()} ${b()}
+"""
+        def positions(node):
+            result = []
+            def walk(n):
+                for c in n.get_children():
+                    assert c.source_file is source_file
+                    result.append((c.lineno, c.pos))
+                    walk(c)
+            source_file = node.nodes[0].source_file
+            walk(node)
+            return result
+
+        previous = Lexer(template, 'foo.html')
+        previous.parse()
+        for old, new in [
+            ('<%def name="a()">', '<%def name="a()">\n\n'),
+            ('${x}', '${x | h}'),
+            ('## a comment\n', ''),
+            ('b</%def>', 'b ${c}\n\n</%def>'),
+        ]:
+            text = template.replace(old, new)
+            expected = Lexer(text, 'foo.html').parse()
+            lexer = Lexer(text, 'foo.html')
+            node = lexer.parse(previous=previous)
+            eq_(repr(node), repr(expected))
+            eq_(positions(node), positions(expected))
+            assert node.nodes[0].source_file is lexer.source_file
+            call = [n for n in node.nodes[0].nodes 
+                        if isinstance(n, parsetree.CallTag)][0]
+            assert call.parent is node.nodes[0]
+
+    def test_incremental_lookahead(self):
+        # the comment within the expression extends to the next
+        # newline, which the edits add or remove after it.
+        for template, old, new in [
+            ("${c#al body()} x ${y}", " x", "\n}"),
+            ("${c#al body()} x ${y}", " x", "\n"),
+            ("${c#al body()}\n}x ${y}", "\n}", ""),
+            ("${c#al body()}ab", "ab", "ab% endif\n"),
+            ("<%x=1%> ${y}", "${y}", "${y}%>"),
+        ]:
+            previous = Lexer(template)
+            previous.parse()
+            text = template.replace(old, new)
+            try:
+                expected = repr(Lexer(text).parse())
+            except exceptions.SyntaxException, e:
+                expected = str(e)
+            try:
+                result = repr(Lexer(text).parse(previous=previous))
+            except exceptions.SyntaxException, e:
+                result = str(e)
+            eq_(result, expected)
+
     def test_text_tag(self):
         template = \
             """
@@ -852,3 +1034,82 @@ hi
         self._compare(nodes, TemplateNode({}, [Text(u'''\n    hi\n''',
                       (1, 1)), Comment(u'old style comment', (3, 1)),
                       Comment(u'another comment', (4, 1))]))
+
+    def test_preprocessor_cache(self):
+        from mako.lexer import preprocessor_cache
+        calls = []
+        class Preproc(object):
+            fingerprint = "test_preprocessor_cache 1"
+            def __call__(self, text):
+                calls.append(text)
+                return text.replace("#", "##")
+
+        template = "\n# comment\nhi"
+        preprocessor_cache.clear()
+        for i in range(3):
+            nodes = Lexer(template, preprocessor=Preproc()).parse()
+            eq_(nodes.nodes[1].text, "comment")
+        eq_(len(calls), 1)
+        eq_(preprocessor_cache.hits, 2)
+        eq_(preprocessor_cache.timings["test.test_lexer.Preproc"][0], 1)
+
+        # a changed fingerprint is a different preprocessor
+        Preproc.fingerprint = "test_preprocessor_cache 2"
+        Lexer(template, preprocessor=Preproc()).parse()
+        eq_(len(calls), 2)
+
+        # without a fingerprint, nothing is cached
+        Preproc.fingerprint = None
+        Lexer(template, preprocessor=Preproc()).parse()
+        Lexer(template, preprocessor=Preproc()).parse()
+        eq_(len(calls), 4)
+
+    def test_preprocessor_fingerprint(self):
+        from mako.lexer import preprocessor_fingerprint
+        def define(source):
+            namespace = {'__name__':'preprocessors'}
+            exec source in namespace
+            return namespace['preproc']
+
+        original = """
+def preproc(text, suffix="!"):
+    return "".join([c.upper() for c in text]) + suffix
+"""
+        fingerprint = preprocessor_fingerprint([define(original)])
+        eq_(preprocessor_fingerprint([define(original)]), fingerprint)
+        assert fingerprint[0].startswith("preprocessors.preproc:")
+
+        # an edited function of the same name is a different
+        # preprocessor
+        for edited in [
+            original.replace("upper", "lower"),
+            original.replace("!", "?"),
+            original.replace('"".join', '" ".join'),
+            original.replace('c.upper()', 'c.upper() + c'),
+        ]:
+            assert preprocessor_fingerprint([define(edited)]) != \
+                        fingerprint, edited
+
+    def test_fused_preprocessors(self):
+        from mako.ext.preprocessors import RegexPreprocessor, fuse, \
+                    convert_comments
+        html_comments = RegexPreprocessor(r"<!--(.*?)-->", 
+                                    r"<%doc>\1</%doc>", name="html")
+        template = """
+    hi <!-- html comment -->
+    # old style comment
+"""
+        fused = fuse(convert_comments, html_comments)
+        eq_(fused(template), html_comments(convert_comments(template)))
+        eq_(
+            repr(Lexer(template, preprocessor=fused).parse()), 
+            repr(Lexer(template, 
+                preprocessor=[convert_comments, html_comments]).parse())
+        )
+        assert fused.fingerprint != fuse(html_comments, 
+                                        convert_comments).fingerprint
+
+        # the patterns are all matched against the original text
+        fused = fuse(RegexPreprocessor("a", "b"), 
+                    RegexPreprocessor("b", "c", re.I))
+        eq_(fused("aB"), "bc")
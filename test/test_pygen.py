@@ -150,6 +150,44 @@ print "more indent"
 
 """
 
+    def test_plain_line(self):
+        stream = StringIO()
+        printer = PythonPrinter(stream)
+        printer.writeline("for x in foo:")
+        printer.writeline_plain("print x # else:")
+        printer.writeline_plain("y = {'a':x}")
+        printer.writeline(None)
+        printer.writeline_plain("print y")
+        assert stream.getvalue() == \
+"""for x in foo:
+    print x # else:
+    y = {'a':x}
+print y
+"""
+
+    def test_source_map(self):
+        stream = StringIO()
+        printer = PythonPrinter(stream)
+        printer.writeline("import lala")
+        printer.start_source(1)
+        printer.writeline("for x in foo:")
+        printer.start_source(2)
+        printer.start_source(3)
+        printer.write_indented_block("""
+            y = x
+            print y""")
+        printer.start_source(3)
+        printer.writeline("print x")
+        printer.writeline(None)
+        printer.start_source(5)
+        printer.writeline_plain("x = foo(1,\n2)")
+        printer.start_source(6)
+        printer.writeline("y = bar(3,\n4)")
+        printer.start_source(7)
+        printer.close()
+        assert printer.lineno == 10
+        assert printer.source_map == ([2, 3, 7, 9, 11], [1, 3, 5, 6, 7])
+
 class WhitespaceTest(unittest.TestCase):
     def test_basic(self):
         text = """
@@ -383,6 +383,13 @@ class EncodingTest(TemplateTest):
         # raises because expression contains an encoded bytestring which cannot be decoded
         self.assertRaises(UnicodeDecodeError, template.render)
 
+    @skip_if(lambda: util.py3k)
+    def test_disable_unicode_after_unicode(self):
+        text = '<%def name="bar(a)">bar ${a}</%def>${bar(2)}'
+        for disable_unicode in (False, True, False):
+            template = Template(text, disable_unicode=disable_unicode)
+            eq_(template.render(), "bar 2")
+
 
 class PageArgsTest(TemplateTest):
     def test_basic(self):
@@ -626,6 +633,69 @@ class UndefinedVarsTest(TemplateTest):
             t.render, y=12
         )
  
+    def test_bind_builtins(self):
+        text = """
+            <%def name="foo(items)">
+                % for i, x in enumerate(items):
+                    ${i}: ${x}
+                % endfor
+            </%def>
+            ${len(items)} ${foo(items)}
+            <%def name="bar()">${next.body()}</%def>
+        """
+        t = Template(text)
+        assert "len = context.get('len', UNDEFINED)" in t.code
+        eq_(result_lines(t.render(items='ab', len=lambda x: 'len')),
+            ['len', '0: a', '1: b'])
+
+        t = Template(text, bind_builtins=True)
+        assert "context.get('len'" not in t.code
+        assert "context.get('enumerate'" not in t.code
+        assert "context.get('next'" in t.code
+        eq_(result_lines(t.render(items='ab', len=lambda x: 'len')),
+            ['2', '0: a', '1: b'])
+
+        l = TemplateLookup(bind_builtins=True)
+        l.put_string("a", text)
+        assert "context.get('len'" not in l.get_template("a").code
+
+    def test_lazy_declares(self):
+        text = """
+            ${a}
+            % if x:
+                ${b} ${c}
+                % if y:
+                    ${d}
+                % elif e:
+                    ${d} ${f}
+                % endif
+            % elif g:
+                ${c}
+            % else:
+                % for i in items:
+                    ${h}
+                % endfor
+            % endif
+        """
+        t = Template(text, lazy_declares=True)
+        prologue = t.code[t.code.index("def render_body"):
+                            t.code.index("if x:")]
+        for name in ('a', 'c', 'g', 'x'):
+            assert "%s = context.get(%r" % (name, name) in prologue
+        for name in ('b', 'd', 'e', 'f', 'h', 'items', 'y'):
+            assert "%s = context.get(%r" % (name, name) not in prologue
+            assert "%s = context.get(%r" % (name, name) in t.code
+
+        data = dict(a=1, b=2, c=3, d=4, e=5, f=6, g=7, h=8, items=[1])
+        for x, y, g in [(1, 1, 0), (1, 0, 0), (0, 0, 1), (0, 0, 0)]:
+            eq_(result_lines(t.render(x=x, y=y, **dict(data, g=g))),
+                result_lines(Template(text).render(x=x, y=y,
+                                                **dict(data, g=g))))
+
+        t = Template(text, lazy_declares=True, strict_undefined=True)
+        eq_(result_lines(t.render(a=1, x=0, g=1, c=3)), ['1', '3'])
+        assert_raises(NameError, t.render, a=1, x=1, c=3)
+
     def test_expression_declared(self):
         t = Template("""
             ${",".join([t for t in ("a", "b", "c")])}
@@ -762,6 +832,170 @@ class ControlTest(TemplateTest):
         #print t.code
         assert flatten_result(t.render()) == "1 2 3"
  
+class StaticTextTest(TemplateTest):
+    def test_coalesced(self):
+        from mako.lexer import Lexer
+        from mako import codegen
+        source = """hello
+## a comment
+<%def name="foo(x=None)" inline="False">foo</%def>
+<%doc>
+    more
+</%doc>
+world ${foo()}"""
+        node = Lexer(source).parse()
+        tree = repr(node)
+        code = codegen.compile(node, "static_text", default_filters=["unicode"])
+        eq_(repr(node), tree)
+
+        # one write for the body's static text, one for foo()
+        eq_(code.count("__M_writer(u'"), 2)
+        assert "__M_writer(u'hello\\n\\n\\nworld ')" in code
+        eq_(Template(source).render_unicode(), u"hello\n\n\nworld foo")
+
+    def test_fused(self):
+        t = Template("""<%def name="foo()" inline="False">foo</%def>
+<a href="${url | u}" class="${len(x) > 1 and 'many' or 'one'}">${title | h} 100%</a>
+${foo()} ${x[0]} ${title | n} ${capture(foo)}""")
+
+        # the text and the first three expressions are written 
+        # together; calls of anything but builtins, and unfiltered 
+        # expressions, are written on their own
+        assert "__M_writer(u'\\n<a href=\"%s\" class=\"%s\">%s 100%%</a>\\n' % (" \
+                    in t.code
+        assert "__M_value = (foo())" in t.code
+        assert "__M_writer(title )" in t.code
+        assert "__M_writer(capture(foo))" in t.code
+        eq_(
+            t.render_unicode(url="a b", x=[1, 2], title="<b>"),
+            u'\n<a href="a+b" class="many">&lt;b&gt; 100%</a>\nfoo 1 <b> foo'
+        )
+
+    def test_fused_order(self):
+        # each expression is filtered before the next is evaluated
+        t = Template("""<b>${x} ${y + 1}</b>""")
+        self.assertRaises(NameError, t.render_unicode, y=None)
+
+    @skip_if(lambda: util.py3k)
+    def test_fused_disable_unicode(self):
+        t = Template("caf\xc3\xa9 ${x | h} ${x | entity} ${x | u}", 
+                        disable_unicode=True, input_encoding='utf-8')
+        # filters returning unicode aren't written with encoded text
+        assert "__M_writer('caf\\xc3\\xa9 %s ' % (" in t.code
+        eq_(t.render(x='<a>'), "caf\xc3\xa9 &lt;a&gt; &lt;a&gt; %3Ca%3E")
+
+    def test_folded(self):
+        text = """<%def name="foo()">foo</%def>
+${'&nbsp;' * 2}${len('abc')} ${"<b>" | h} ${x} ${'a b' | u, trim}
+<% min = max %>${min(1, 2)}"""
+        t = Template(text)
+
+        # constant expressions are written with the text around them
+        assert "__M_writer(u'\\n&nbsp;&nbsp;%s &lt;b&gt; %s a+b\\n' % (" \
+                    in t.code
+        # but a builtin is looked up in the context
+        assert "__M_unicode(len('abc'))," in t.code
+        eq_(
+            t.render_unicode(x=5),
+            u'\n&nbsp;&nbsp;3 &lt;b&gt; 5 a+b\n2'
+        )
+        eq_(
+            t.render_unicode(x=5, len=lambda x:42),
+            u'\n&nbsp;&nbsp;42 &lt;b&gt; 5 a+b\n2'
+        )
+
+        # calls of builtins are folded when they're bound
+        t = Template(text, bind_builtins=True)
+        assert "__M_writer(u'\\n&nbsp;&nbsp;3 &lt;b&gt; %s a+b\\n' % (" \
+                    in t.code
+        # unless a builtin is assigned to by the template
+        assert "min(1, 2)" in t.code
+        eq_(
+            t.render_unicode(x=5),
+            u'\n&nbsp;&nbsp;3 &lt;b&gt; 5 a+b\n2'
+        )
+
+    def test_folded_filters_shadowed(self):
+        # filters which the template binds itself aren't applied 
+        # at compile time
+        t = Template("""<%! str = lambda x: 'S' %>${'a' | str} ${1 | str}""")
+        eq_(t.render_unicode(), u"S S")
+        t = Template("""<%! str = lambda x: 'S' %>${'a' | str}""", 
+                        bind_builtins=True)
+        eq_(t.render_unicode(), u"S")
+        t = Template("""<% unicode = lambda x: u'U' %>${2 | h}""")
+        eq_(t.render_unicode(), u"U")
+
+    def test_static_defs(self):
+        t = Template("""<%def name="foo()">foo ${'&' | h}</%def>
+<%def name="bar()">bar</%def>
+<%block name="header">header</%block>
+${foo()} ${self.foo()} ${bar() | trim}
+<%def name="baz()"><% foo = bar %>${foo()}</%def>
+${baz()}""")
+
+        # the output of a def with no arguments and only static 
+        # content is written in place of a plain call of it
+        assert "context.writer()(u'foo &amp;')" in t.code
+        assert "__M_value = (self.foo())" in t.code
+        assert "(bar())" not in t.code
+        # but not where the name is rebound
+        assert "__M_value = (foo())" in t.code
+        # blocks are still called through self, for inheritance
+        assert "context['self'].header(**pageargs)" in t.code
+        assert "context.writer()(u'header')" in t.code
+        eq_(
+            flatten_result(t.render_unicode()),
+            u"header foo &amp; foo &amp; bar bar"
+        )
+
+    def test_static_defs_filters_shadowed(self):
+        # the filters of a call of a static def which the template 
+        # binds itself are applied to its return value at runtime
+        t = Template("""<%def name="f()">a ${'b'}</%def>"""
+                        """<% str = lambda x: 'S' %>${f() | str}""")
+        assert "context.writer()(u'a b')" in t.code
+        eq_(t.render_unicode(), u"a bS")
+
+    def test_static_defs_builtins(self):
+        text = """<%def name="foo()" inline="False">${len('ab')}</%def>"""\
+                """${foo()}"""
+        # a builtin is looked up in the context
+        t = Template(text)
+        assert "len = context.get('len', UNDEFINED)" in t.code
+        eq_(t.render_unicode(len=lambda x:42), u"42")
+        # unless it's bound
+        t = Template(text, bind_builtins=True)
+        assert "context.writer()(u'2')" in t.code
+        eq_(t.render_unicode(), u"2")
+
+    def test_joined_loop(self):
+        t = Template("""<%def name="sep()"><hr/></%def>
+% for x in range(3): # comment
+${'&nbsp;' * 2}${sep()}
+% endfor
+% for y in range(2):
+${y}
+% endfor
+${x}""")
+        # a loop writing only static text is written with one call
+        assert "__M_writer(u''.join([u'&nbsp;&nbsp;<hr/>\\n' " \
+                    "for x in range(3)]))" in t.code
+        assert "for y in range(2):" in t.code
+        eq_(
+            t.render_unicode(),
+            u"\n" + u"&nbsp;&nbsp;<hr/>\n" * 3 + u"0\n1\n2"
+        )
+
+    def test_static_block_override(self):
+        l = TemplateLookup()
+        l.put_string("base", """<%block name="header">base</%block>"""
+                            """ ${self.foo()}<%def name="foo()">foo</%def>""")
+        l.put_string("child", """<%inherit file="base"/>"""
+                            """<%block name="header">child</%block>"""
+                            """<%def name="foo()">child foo</%def>""")
+        eq_(l.get_template("child").render_unicode(), u"child child foo")
+
 class GlobalsTest(TemplateTest):
     def test_globals(self):
         self._do_memory_test(
@@ -986,3 +1220,116 @@ class PreprocessTest(TemplateTest):
 """, preprocessor=convert_comments)
 
         assert flatten_result(t.render()) == "im a template - # not a comment - ## not a comment"
+
+class IncrementalLexingTest(TemplateTest):
+    def _write(self, path, text):
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+
+    def test_edit(self):
+        from mako.lexer import Lexer
+        path = os.path.join(module_base, 'incremental.html')
+        source = """
+<%def name="a()">a ${x}</%def>
+<%def name="b()">b ${x}</%def>
+<%def name="c()">c ${x}</%def>
+${a()} ${b()} ${c()}
+"""
+        self._write(path, source)
+        t = Template(filename=path, incremental_lexing=True)
+        eq_(flatten_result(t.render(x=1)), "a 1 b 1 c 1")
+
+        # only the edited def is lexed again
+        self._write(path, source.replace("b ${x}", "b ${x + 1}"))
+        match_expression = Lexer.match_expression
+        lexed = []
+        def match(self):
+            lexed.append(self.match_position)
+            return match_expression(self)
+        Lexer.match_expression = match
+        try:
+            t = Template(filename=path, incremental_lexing=True)
+        finally:
+            Lexer.match_expression = match_expression
+        eq_(len(lexed), 1)
+        eq_(flatten_result(t.render(x=1)), "a 1 b 2 c 1")
+        def code(t):
+            return re.sub(r"_modified_time = .*", "", t.code)
+        eq_(code(t), code(Template(filename=path)))
+
+        os.remove(path)
+
+class ParseTreeCacheTest(TemplateTest):
+    def _without_lexing(self, fn):
+        from mako.lexer import Lexer
+        parse = Lexer.parse
+        def fail(self, previous=None):
+            assert False, "template was lexed"
+        Lexer.parse = fail
+        try:
+            return fn()
+        finally:
+            Lexer.parse = parse
+
+    def test_memory(self):
+        source = "hello ${x}"
+        t = Template(source, parsetree_cache=True)
+        eq_(t.render(x=5), "hello 5")
+        t2 = self._without_lexing(
+                    lambda: Template(source, parsetree_cache=True,
+                                        default_filters=['h']))
+        eq_(t2.render(x='<5>'), "hello &lt;5&gt;")
+
+    def test_not_enabled(self):
+        source = "not cached ${x}"
+        Template(source)
+        assert_raises(AssertionError, self._without_lexing, 
+                    lambda: Template(source))
+
+    def test_lexer_options_in_key(self):
+        source = "options ${x}"
+        Template(source, parsetree_cache=True)
+        assert_raises(AssertionError, self._without_lexing, 
+                    lambda: Template(source, parsetree_cache=True,
+                                        filename="options.html"))
+        assert_raises(AssertionError, self._without_lexing, 
+                    lambda: Template(source, parsetree_cache=True,
+                                        disable_unicode=True))
+
+    def test_preprocessor(self):
+        source = """
+        preprocessed
+# old style comment
+"""
+        t = Template(source, preprocessor=convert_comments, 
+                                    parsetree_cache=True)
+        t2 = self._without_lexing(
+                    lambda: Template(source, preprocessor=convert_comments,
+                                    parsetree_cache=True))
+        eq_(flatten_result(t2.render()), "preprocessed")
+
+        # lambdas can't be identified; never cached
+        source = "lambda preprocessed"
+        preproc = lambda text: text
+        Template(source, preprocessor=preproc, parsetree_cache=True)
+        assert_raises(AssertionError, self._without_lexing, 
+                    lambda: Template(source, preprocessor=preproc,
+                                        parsetree_cache=True))
+
+    def test_module_directory(self):
+        from mako import template
+        path = os.path.join(module_base, 'unicode.html.py')
+        if os.path.exists(path):
+            os.remove(path)
+        t = self._file_template("unicode.html", parsetree_cache=True)
+        assert os.path.exists(path + ".tree")
+
+        # a new process with a stale module file
+        template._parsetrees.clear()
+        os.remove(path)
+        t2 = self._without_lexing(
+                    lambda: self._file_template("unicode.html", 
+                                            parsetree_cache=True))
+        eq_(t2.render_unicode(), t.render_unicode())
+        assert os.path.exists(path)